@@ -9,6 +9,7 @@ __version__ = '1.0.1'
 from .airflow import *
 from .mlflow import get_client as get_mlflow_client
 from .databricks import Databricks
+from .databricks_async import AsyncDatabricks
 from .requests import Requests
 
 __all__ = [airflow, mlflow, databricks, requests]
\ No newline at end of file
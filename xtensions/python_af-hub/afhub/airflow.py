@@ -3,6 +3,7 @@ from . import databricks
 from airflow.exceptions import AirflowException
 from airflow.models import BaseOperator, SkipMixin
 from airflow.models.dag import DagContext
+from airflow.stats import Stats
 from airflow.utils.task_group import TaskGroup
 from airflow.utils.decorators import apply_defaults
 from airflow.utils.file import TemporaryDirectory
@@ -16,6 +17,7 @@ import json
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import textwrap
+import datetime
 
 from airflow.providers.cncf.kubernetes.operators.kubernetes_pod import (
     KubernetesPodOperator,
@@ -416,6 +418,11 @@ class DatabricksOperator(BaseOperator):
         name of an existing cluster
     terminate_cluster : bool
         terminate cluster after finishing the job
+    cluster_pool : int
+        run on a warm cluster of the new_cluster spec leased from a pool of this
+        size shared by the tasks of the DAG run, instead of a new job cluster
+    cluster_idle_timeout : int
+        seconds a pooled cluster stays up without a task
     """
     template_fields = ('templates_dict',)
     template_ext = tuple()
@@ -438,6 +445,8 @@ class DatabricksOperator(BaseOperator):
             new_cluster=None,
             existing_cluster_id=None,
             terminate_cluster=True,
+            cluster_pool=None,
+            cluster_idle_timeout=600,
             # provide_context=False,
             templates_dict=None,
             templates_exts=None,
@@ -459,6 +468,8 @@ class DatabricksOperator(BaseOperator):
         self.new_cluster = new_cluster
         self.existing_cluster_id = existing_cluster_id
         self.terminate_cluster = terminate_cluster if existing_cluster_id else False
+        self.cluster_pool = cluster_pool if new_cluster else None
+        self.cluster_idle_timeout = cluster_idle_timeout
         self.dry_run = dry_run
 
     def add_library(self, lib: LibraryOperator):
@@ -522,34 +533,67 @@ class DatabricksOperator(BaseOperator):
 
             targetFile = os.path.join(self.dagfolder, self.inputFile)[26:]
 
-            dbr.mkdirs(os.path.dirname(targetFile))
+            # unchanged notebooks and known folders are skipped, a missing folder is
+            # created by the import
+            dbr.mkdirs(os.path.dirname(targetFile), skip_existing=True)
 
             dbr.import_ipynb(
                 os.path.join(self.dagfolder, self.inputFile),
-                targetFile)
+                targetFile, skip_unchanged=True)
+
+            new_cluster = self.new_cluster
+            existing_cluster_id = self.existing_cluster_id
+            pool = None
+            if self.cluster_pool and self.dry_run == False:
+                pool = databricks.ClusterPool(
+                    dbr, self.cluster_pool, self.cluster_idle_timeout,
+                    scope="{}/{}".format(self.dagName, self.dagrun.run_id))
+                existing_cluster_id = pool.acquire(self.new_cluster, self.task_id)
+                new_cluster = None
 
-            job = dbr.assure_job(
-                targetFile,
-                targetFile,
-                self.new_cluster,
-                self.existing_cluster_id,
-                self.libraries
-            )
-
-            if self.dry_run == False:
-                print("job_id: {}".format(job["job_id"]))
-                run = dbr.run_job(job["job_id"], self.parameters)
-
-                print("run_id: {}".format(run["run_id"]))
-                run_res = dbr.await_run(run["run_id"])
-
-                dbr.run_export(run["run_id"], outputFileName)
-
-                if run_res["state"]["result_state"] != "SUCCESS":
-                    raise Exception("Databricks run failed")
-
-                if self.terminate_cluster:
-                    dbr.terminate_cluster(self.existing_cluster_id)
+            try:
+                job = dbr.assure_job(
+                    targetFile,
+                    targetFile,
+                    new_cluster,
+                    existing_cluster_id,
+                    self.libraries
+                )
+
+                if self.dry_run == False:
+                    print("job_id: {}".format(job["job_id"]))
+                    run = dbr.run_job(job["job_id"], self.parameters)
+
+                    print("run_id: {}".format(run["run_id"]))
+                    run_res = dbr.await_run(run["run_id"])
+                    if "detection_lag" in run_res:
+                        Stats.timing("databricks.run_detection_lag",
+                                     datetime.timedelta(seconds=run_res["detection_lag"]))
+                        res["detection_lag"] = run_res["detection_lag"]
+
+                    dbr.run_export(run["run_id"], outputFileName)
+
+                    if run_res.get("start_time") and run_res.get("end_time"):
+                        res["run_seconds"] = (run_res["end_time"] - run_res["start_time"]) / 1000
+                        Stats.timing("databricks.run_duration",
+                                     datetime.timedelta(seconds=res["run_seconds"]))
+
+                    if run_res["state"].get("result_state") != "SUCCESS":
+                        raise Exception("Databricks run failed")
+
+                    if self.terminate_cluster:
+                        dbr.terminate_cluster(self.existing_cluster_id)
+            finally:
+                if pool is not None:
+                    pool.release(existing_cluster_id)
+
+                    # cluster wait vs. run time, in StatsD and the XCom of the task
+                    timings = pool.timings.get(existing_cluster_id, {})
+                    for key in ("wait_seconds", "lease_seconds"):
+                        if key in timings:
+                            Stats.timing("databricks.cluster_" + key[:-len("_seconds")],
+                                         datetime.timedelta(seconds=timings[key]))
+                            res["cluster_" + key] = timings[key]
 
         except Exception as ex:
 
@@ -614,6 +658,16 @@ class UploadToDatabricks(BaseOperator):
     ----------
     inputFile : str, list
         the file to copy to the Databricks FileStore
+    max_workers : int
+        number of files uploaded concurrently
+    resume : bool
+        continue interrupted uploads of unchanged files
+    compression : str
+        compress the transfer with "gzip", "zstd" or "auto", the file is stored with the suffix .gz or .zst
+    sync : bool
+        only copy files or directories which changed since the last transfer, without compression
+    dry_run : bool
+        with sync, only report what would be copied
     """
     template_fields = ('templates_dict',)
     template_ext = tuple()
@@ -627,6 +681,11 @@ class UploadToDatabricks(BaseOperator):
     def __init__(
             self,
             inputFile,
+            max_workers=4,
+            resume=True,
+            compression=None,
+            sync=False,
+            dry_run=False,
             op_args=None,
             op_kwargs=None,
             templates_dict=None,
@@ -640,6 +699,14 @@ class UploadToDatabricks(BaseOperator):
             self.template_ext = templates_exts
 
         self.inputFile = inputFile
+        self.max_workers = max_workers
+        self.resume = resume
+        self.compression = compression
+        self.sync = sync
+        self.dry_run = dry_run
+
+        if sync and compression:
+            raise Exception("compression can not be combined with sync")
 
     def execute(self, context):
         return_value = self.execute_callable()
@@ -650,11 +717,15 @@ class UploadToDatabricks(BaseOperator):
 
         dbr = databricks.Databricks()
 
+        if self.sync:
+            inputFiles = self.inputFile if isinstance(self.inputFile, list) else [self.inputFile]
+            return [el for inputFile in inputFiles
+                    for el in dbr.sync_upload(inputFile, dry_run=self.dry_run, max_workers=self.max_workers)]
+
         if isinstance(self.inputFile, list):
-            for el in self.inputFile:
-                dbr.upload_file(el)
+            dbr.upload_files(self.inputFile, self.max_workers, self.resume, self.compression)
         else:
-            dbr.upload_file(self.inputFile)
+            dbr.upload_file(self.inputFile, resume=self.resume, compression=self.compression)
 
         return {}
 
@@ -667,7 +738,15 @@ class DownloadFromDatabricks(BaseOperator):
     Attributes
     ----------
     inputFile : str, list
-        the file to collect from the Databricks FileStore
+        the file or directory to collect from the Databricks FileStore
+    max_workers : int
+        number of ranges and files downloaded concurrently
+    compression : str
+        compress the transfer with "gzip", "zstd" or "auto", the file is stored with the suffix .gz or .zst
+    sync : bool
+        only copy files or directories which changed since the last transfer, without compression
+    dry_run : bool
+        with sync, only report what would be copied
     """
     template_fields = ('templates_dict',)
     template_ext = tuple()
@@ -681,6 +760,10 @@ class DownloadFromDatabricks(BaseOperator):
     def __init__(
             self,
             inputFile,
+            max_workers=8,
+            compression=None,
+            sync=False,
+            dry_run=False,
             op_args=None,
             op_kwargs=None,
             templates_dict=None,
@@ -694,6 +777,13 @@ class DownloadFromDatabricks(BaseOperator):
             self.template_ext = templates_exts
 
         self.inputFile = inputFile
+        self.max_workers = max_workers
+        self.compression = compression
+        self.sync = sync
+        self.dry_run = dry_run
+
+        if sync and compression:
+            raise Exception("compression can not be combined with sync")
 
     def execute(self, context):
         return_value = self.execute_callable()
@@ -704,11 +794,16 @@ class DownloadFromDatabricks(BaseOperator):
 
         dbr = databricks.Databricks()
 
+        if self.sync:
+            inputFiles = self.inputFile if isinstance(self.inputFile, list) else [self.inputFile]
+            return [el for inputFile in inputFiles
+                    for el in dbr.sync_download(inputFile, dry_run=self.dry_run, max_workers=self.max_workers)]
+
         if isinstance(self.inputFile, list):
             for el in self.inputFile:
-                dbr.download_file(el)
+                dbr.download_file(el, max_workers=self.max_workers, compression=self.compression)
         else:
-            dbr.download_file(self.inputFile)
+            dbr.download_file(self.inputFile, max_workers=self.max_workers, compression=self.compression)
 
         return {}
 
@@ -1,8 +1,49 @@
 import json
 import requests
 import base64
+import hashlib
 import os
 import time
+import random
+import fcntl
+import threading
+import socket
+import zlib
+import contextlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .metrics import Registry
+
+# DBFS accepts at most 1 MB per add-block or put call
+BLOCK_SIZE = 1 << 20
+
+# status codes retried with backoff
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# calls which must not run twice, they are only retried if the server did not process them
+UNSAFE_ACTIONS = ("/api/2.0/dbfs/add-block", "/api/2.0/jobs/create", "/api/2.0/jobs/run-now",
+                  "/api/2.0/clusters/create")
+
+# life cycle states of a finished run
+TERMINAL_STATES = ("TERMINATED", "SKIPPED", "INTERNAL_ERROR")
+
+metrics = Registry()
+request_latency = metrics.histogram(
+    "databricks_request_seconds", "Latency of the Databricks API calls by endpoint",
+    [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0], ("endpoint",))
+request_retries = metrics.counter(
+    "databricks_request_retries_total", "Retried Databricks API calls by endpoint and reason",
+    ("endpoint", "reason"))
+run_detection_lag = metrics.histogram(
+    "databricks_run_detection_seconds", "Time from the end of a run until it was noticed by polling",
+    [1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0])
+cluster_wait = metrics.histogram(
+    "databricks_cluster_wait_seconds", "Time a task waited for a running cluster of the pool",
+    [1.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1200.0])
+cluster_lease = metrics.histogram(
+    "databricks_cluster_lease_seconds", "Time a task held a cluster of the pool",
+    [10.0, 60.0, 300.0, 600.0, 1800.0, 3600.0, 7200.0])
 
 
 class _DatabricksIFrame(object):
@@ -31,6 +72,181 @@ class _DatabricksIFrame(object):
         return self.iframe.format(data=self.src)
 
 
+class _JsonStore(object):
+    """
+    A JSON dict kept in the state folder. Saving merges the changed keys into
+    the current file under a file lock, so concurrent tasks do not lose entries
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._changed = {}
+        self.data = self._read()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self.data[key] = value
+            self._changed[key] = value
+
+    def delete(self, key):
+        with self._lock:
+            self.data.pop(key, None)
+            self._changed[key] = None
+
+    def save(self):
+        with self._lock:
+            changed, self._changed = self._changed, {}
+        if not changed:
+            return
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            data = self._read()
+            for key, value in changed.items():
+                if value is None:
+                    data.pop(key, None)
+                else:
+                    data[key] = value
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(data, f)
+            os.replace(self.path + ".tmp", self.path)
+
+        with self._lock:
+            data.update(self._changed)
+            self.data = {key: value for key, value in data.items() if value is not None}
+
+
+def _file_hash(path):
+    """
+    sha256 of a local file
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _contains(value, expected):
+    """
+    Check if value has all entries of expected, dicts may have additional keys
+    """
+    if isinstance(expected, dict):
+        return isinstance(value, dict) and all(
+            key in value and _contains(value[key], el) for key, el in expected.items())
+    if isinstance(expected, list):
+        return isinstance(value, list) and len(value) == len(expected) and all(
+            _contains(a, b) for a, b in zip(value, expected))
+    return value == expected
+
+
+def _normalized(value):
+    """
+    Drop None values and empty lists or dicts, the API omits them in the job settings it returns
+    """
+    if isinstance(value, dict):
+        value = {key: _normalized(el) for key, el in value.items()}
+        return {key: el for key, el in value.items() if el is not None and el != [] and el != {}}
+    if isinstance(value, list):
+        return [_normalized(el) for el in value]
+    return value
+
+
+def _file_blocks(path, offset=0):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            yield block
+
+
+def _handle_expired(ex):
+    """
+    Check if an exception is the API error of an unknown or expired DBFS handle
+    """
+    res = ex.args[0] if ex.args else None
+    return isinstance(res, dict) and res.get("error_code") in ("RESOURCE_DOES_NOT_EXIST", "INVALID_PARAMETER_VALUE")
+
+
+# file suffix of the compressed uploads
+COMPRESSION_SUFFIX = {"gzip": ".gz", "zstd": ".zst"}
+
+
+def _compression(name):
+    """
+    Resolve a compression name, auto selects zstd if zstandard is installed
+    """
+    if name == "auto":
+        try:
+            import zstandard
+            return "zstd"
+        except ImportError:
+            return "gzip"
+    if name and name not in COMPRESSION_SUFFIX:
+        raise Exception("Unknown compression {}".format(name))
+    return name
+
+
+def _compressor(compression):
+    if compression == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def _compressed_blocks(path, compression):
+    """
+    Compress a file block by block and yield the output in blocks of BLOCK_SIZE
+    """
+    compressor = _compressor(compression)
+    buffer = bytearray()
+    for block in _file_blocks(path):
+        buffer += compressor.compress(block)
+        while len(buffer) >= BLOCK_SIZE:
+            yield bytes(buffer[:BLOCK_SIZE])
+            del buffer[:BLOCK_SIZE]
+    buffer += compressor.flush()
+    while buffer:
+        yield bytes(buffer[:BLOCK_SIZE])
+        del buffer[:BLOCK_SIZE]
+
+
+def open_compressed(path):
+    """
+    Open a .gz or .zst file for streaming reads of the uncompressed content
+    """
+    if path.endswith(COMPRESSION_SUFFIX["zstd"]):
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    import gzip
+    return gzip.open(path, "rb")
+
+
+def decompress_file(path, targetPath=None):
+    """
+    Decompress a downloaded file, the target defaults to the path without the suffix
+    """
+    if not targetPath:
+        targetPath = os.path.splitext(path)[0]
+
+    with open_compressed(path) as src, open(targetPath + ".part", "wb") as dst:
+        for block in iter(lambda: src.read(BLOCK_SIZE), b""):
+            dst.write(block)
+    os.replace(targetPath + ".part", targetPath)
+    return targetPath
+
+
 class Databricks:
     """
     A interface class to controll Databricks remotely via the 2.0 api
@@ -49,6 +265,27 @@ class Databricks:
         self.token = config["Databricks"]["TOKEN"]
         self.registry = config["Databricks"]["REGISTRY"]
         self.user = config["Databricks"]["USER"]
+        self.state_dir = config["Databricks"].get(
+            "STATE_DIR", os.path.expanduser("~/.afhub"))
+        pool_size = config["Databricks"].getint("POOL_SIZE", 16)
+        self.timeout = (config["Databricks"].getfloat("CONNECT_TIMEOUT", 10),
+                        config["Databricks"].getfloat("READ_TIMEOUT", 120))
+        self.max_retries = config["Databricks"].getint("MAX_RETRIES", 5)
+        self.backoff = config["Databricks"].getfloat("BACKOFF", 0.5)
+        self.max_backoff = config["Databricks"].getfloat("MAX_BACKOFF", 60)
+        self.poll_min_delay = config["Databricks"].getfloat("POLL_MIN_DELAY", 2)
+        self.poll_max_delay = config["Databricks"].getfloat("POLL_MAX_DELAY", 120)
+        self.poll_factor = config["Databricks"].getfloat("POLL_FACTOR", 0.1)
+
+        self._stores = {}
+
+        # keep-alive connections shared by all calls of this client
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = 'Bearer %s' % self.token
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
         # initilaize mlflow connection
         os.environ["MLFLOW_TRACKING_TOKEN"] = self.token
@@ -56,26 +293,87 @@ class Databricks:
         mlflow.set_registry_uri(self.registry)
         self.mlflow = MlflowClient()
 
+    def _retry_delay(self, attempt, response=None):
+        """
+        Exponential backoff with jitter, a Retry-After header of the response takes precedence
+        """
+        if response is not None and "Retry-After" in response.headers:
+            try:
+                return min(float(response.headers["Retry-After"]), self.max_backoff)
+            except ValueError:
+                pass
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _databricks_request(self, method, action, body=None):
+        """
+        Make a databricks API request over the shared session. Throttled calls, server
+        errors and connection problems are retried with exponential backoff, calls in
+        UNSAFE_ACTIONS only when the server did not process them.
+        """
+        endpoint = action.split("?")[0]
+        safe = method == "GET" or endpoint not in UNSAFE_ACTIONS
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                response = self.session.request(
+                    method, self.registry + action, json=body, timeout=self.timeout)
+            except (requests.exceptions.ConnectTimeout, requests.exceptions.ConnectionError,
+                    requests.exceptions.ReadTimeout) as ex:
+                request_latency.labels(endpoint).observe(time.monotonic() - start)
+                retry = isinstance(ex, requests.exceptions.ConnectTimeout) or safe
+                if not retry or attempt >= self.max_retries:
+                    raise
+                request_retries.labels(endpoint, type(ex).__name__).inc()
+                time.sleep(self._retry_delay(attempt))
+                attempt += 1
+                continue
+
+            request_latency.labels(endpoint).observe(time.monotonic() - start)
+            retry = response.status_code == 429 or (safe and response.status_code in RETRY_STATUS)
+            if not retry or attempt >= self.max_retries:
+                break
+            request_retries.labels(endpoint, str(response.status_code)).inc()
+            time.sleep(self._retry_delay(attempt, response))
+            attempt += 1
+
+        try:
+            return response.json()
+        except ValueError:
+            return {"error_code": str(response.status_code), "message": response.text}
+
     def _databricks_post(self, action, body):
         """
         A helper function to make the databricks API post request, request/response is encoded/decoded as JSON
         """
-        response = requests.post(
-            self.registry + action,
-            headers={'Authorization': 'Bearer %s' % self.token},
-            json=body
-        )
-        return response.json()
+        return self._databricks_request("POST", action, body)
 
     def _databricks_get(self, action):
         """
         A helper function to make the databricks API get request, request/response is encoded/decoded as JSON
         """
-        response = requests.get(
-            self.registry + action,
-            headers={'Authorization': 'Bearer %s' % self.token}
-        )
-        return response.json()
+        return self._databricks_request("GET", action)
+
+    def request_stats(self):
+        """
+        Latency histograms of the API calls by endpoint
+        """
+        return {values[0]: child.to_dict() for values, child in list(request_latency.children.items())}
+
+    def run_stats(self):
+        """
+        Histogram of the delay between the end of a run and its detection by a poll
+        """
+        return run_detection_lag.labels().to_dict()
+
+    def _store(self, name):
+        """
+        The JSON store with the given name in the state folder
+        """
+        if name not in self._stores:
+            self._stores[name] = _JsonStore(os.path.join(self.state_dir, name + ".json"))
+        return self._stores[name]
 
     def _get_job_config(self, name, fullPath, new_cluster=None, existing_cluster_id=None, libraries=None):
         """
@@ -113,14 +411,67 @@ class Databricks:
         """
         return os.path.join("/Users/", self.user, fileName)
 
-    def upload_file(self, localFile, targetFile=None):
+    def _upload_state_file(self, fullPath):
         """
-        Upload a data file to the FileStore
+        Helper to compute the file keeping the progress of an upload to fullPath
+        """
+        key = hashlib.sha1(fullPath.encode("utf-8")).hexdigest()
+        return os.path.join(self.state_dir, "uploads", key + ".json")
 
-        If targetFile is not defined and the localFile is located in
-        the FileStore, this file is used for the upload.
+    def _load_upload_state(self, stateFile, localFile, fullPath):
+        """
+        Load the progress of an interrupted upload, if it belongs to the same local file
+        """
+        try:
+            with open(stateFile) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        stat = os.stat(localFile)
+        if state.get("localFile") != os.path.abspath(localFile) or state.get("path") != fullPath \
+                or state.get("size") != stat.st_size or state.get("mtime") != stat.st_mtime:
+            return None
+        return state
+
+    def _save_upload_state(self, stateFile, state):
+        os.makedirs(os.path.dirname(stateFile), exist_ok=True)
+        with open(stateFile + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(stateFile + ".tmp", stateFile)
+
+    def _add_blocks(self, handle, blocks, onBlock, prefetch=4):
+        """
+        Append the blocks of an iterator to the handle. The blocks are produced and
+        base64 encoded in a background thread, up to prefetch blocks ahead of the
+        request in flight, so reading, encoding and the round trips overlap
         """
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            def encode():
+                block = next(blocks, b"")
+                return len(block), base64.standard_b64encode(block).decode("utf-8")
+
+            pending = deque(pool.submit(encode) for _ in range(prefetch))
+            while True:
+                length, data = pending.popleft().result()
+                if not length:
+                    break
+                pending.append(pool.submit(encode))
+
+                res = self._databricks_post(
+                    "/api/2.0/dbfs/add-block", {"handle": handle, "data": data})
+
+                if "error_code" in res:
+                    for future in pending:
+                        future.cancel()
+                    raise Exception(res)
 
+                onBlock(length)
+
+    def _upload_paths(self, localFile, targetFile=None):
+        """
+        Helper to compute the local file and the full DBFS path of an upload
+        """
         if not targetFile:
             checkLocalFile = os.path.join(
                 "/home/admin/workflow/FileStore", localFile)
@@ -133,36 +484,159 @@ class Databricks:
 
         fullPath = os.path.join(
             "/FileStore/shared_uploads", self.user, targetFile)
+        return localFile, fullPath
+
+    def upload_file(self, localFile, targetFile=None, resume=True, compression=None):
+        """
+        Upload a data file to the FileStore
+
+        If targetFile is not defined and the localFile is located in
+        the FileStore, this file is used for the upload.
+
+        Files larger than a block are streamed through a DBFS handle. The progress
+        is recorded in the state folder, with resume an interrupted upload of the
+        same unchanged file continues at the last written block while its handle
+        is still valid. The size of the closed file is checked, a mismatch restarts
+        the upload once from the beginning.
+
+        With compression "gzip", "zstd" or "auto" the file is compressed block by
+        block while it is sent and stored with the suffix .gz or .zst. The files are
+        plain gzip or zstd streams, afhub is not needed to read them on a cluster:
+
+            pd.read_csv("/dbfs/FileStore/shared_uploads/user/data.csv.gz", compression="gzip")
+            gzip.open("/dbfs/FileStore/shared_uploads/user/data.csv.gz")
+            pd.read_csv("/dbfs/FileStore/shared_uploads/user/data.csv.zst", compression="zstd")
+
+        Reading .zst files needs zstandard on the cluster, pandas supports it from 1.4.
+        """
+
+        localFile, fullPath = self._upload_paths(localFile, targetFile)
+        compression = _compression(compression)
+        if compression:
+            fullPath += COMPRESSION_SUFFIX[compression]
         print("upload {} => {}".format(localFile, fullPath))
 
-        # Create a handle that will be used to add blocks
-        res = self._databricks_post(
-            "/api/2.0/dbfs/create", {"path": fullPath, "overwrite": "true"})
+        start = time.monotonic()
+        stat = os.stat(localFile)
+        size = stat.st_size
+        stored = [0]
 
-        if "error_code" in res:
-            raise Exception(res)
+        def count(length):
+            stored[0] += length
 
-        handle = res['handle']
+        if compression:
+            # the compressed size is unknown up front, always stream through a handle
+            res = self._databricks_post(
+                "/api/2.0/dbfs/create", {"path": fullPath, "overwrite": "true"})
+
+            if "error_code" in res:
+                raise Exception(res)
+
+            self._add_blocks(res['handle'], _compressed_blocks(localFile, compression), count)
+            res = self._databricks_post("/api/2.0/dbfs/close", {"handle": res['handle']})
+
+            if "error_code" in res:
+                raise Exception(res)
+
+        elif size <= BLOCK_SIZE:
+            # small files need a single call
+            with open(localFile, "rb") as f:
+                data = base64.standard_b64encode(f.read()).decode("utf-8")
+            res = self._databricks_post(
+                "/api/2.0/dbfs/put", {"path": fullPath, "contents": data, "overwrite": True})
+
+            if "error_code" in res:
+                raise Exception(res)
+            stored[0] = size
+        else:
+            stateFile = self._upload_state_file(fullPath)
+            state = self._load_upload_state(stateFile, localFile, fullPath) if resume else None
+            resumed = state is not None
+            restarted = False
+
+            def progress(length):
+                count(length)
+                self._save_upload_state(stateFile, dict(state, offset=stored[0]))
+
+            if resumed:
+                print("resume upload of {} at {} bytes".format(fullPath, state["offset"]))
 
-        # add data in chunks
-        with open(localFile, "rb") as f:
             while True:
-                # A block can be at most 1MB
-                block = f.read(1 << 20)
-                if not block:
-                    break
-                data = base64.standard_b64encode(block).decode("utf-8")
-                res = self._databricks_post(
-                    "/api/2.0/dbfs/add-block", {"handle": handle, "data": data})
+                if state is None:
+                    # Create a handle that will be used to add blocks
+                    res = self._databricks_post(
+                        "/api/2.0/dbfs/create", {"path": fullPath, "overwrite": "true"})
+
+                    if "error_code" in res:
+                        raise Exception(res)
+
+                    state = {"localFile": os.path.abspath(localFile), "path": fullPath,
+                             "size": size, "mtime": stat.st_mtime, "handle": res['handle'], "offset": 0}
+                    self._save_upload_state(stateFile, state)
+
+                stored[0] = state["offset"]
+                try:
+                    self._add_blocks(state["handle"], _file_blocks(localFile, state["offset"]), progress)
+
+                    # close handle
+                    res = self._databricks_post("/api/2.0/dbfs/close", {"handle": state["handle"]})
+
+                    if "error_code" in res:
+                        raise Exception(res)
+                except Exception as ex:
+                    if not resumed or not _handle_expired(ex):
+                        raise
+                    # the handle expired, start over
+                    print("resume failed, restart upload: {}".format(ex))
+                    state = None
+                    resumed = False
+                    continue
+
+                os.remove(stateFile)
+
+                # a block sent again after a lost response is appended twice,
+                # the size of the closed file reveals it
+                res = self._databricks_get("/api/2.0/dbfs/get-status?path={}".format(fullPath))
 
                 if "error_code" in res:
                     raise Exception(res)
+                if res["file_size"] == size:
+                    break
+                if restarted:
+                    raise Exception("Upload of {} has {} bytes instead of {}".format(
+                        fullPath, res["file_size"], size))
 
-        # close handle
-        res = self._databricks_post("/api/2.0/dbfs/close", {"handle": handle})
+                print("upload of {} has {} bytes instead of {}, restart upload".format(
+                    fullPath, res["file_size"], size))
+                state = None
+                resumed = False
+                restarted = True
 
-        if "error_code" in res:
-            raise Exception(res)
+        duration = time.monotonic() - start
+        print("uploaded {} in {:.1f} s ({:.1f} MB/s){}".format(
+            fullPath, duration, size / 1e6 / max(duration, 1e-6),
+            ", {:.1f} MB compressed {:.2f}x".format(stored[0] / 1e6, size / max(stored[0], 1)) if compression else ""))
+
+        return {"path": fullPath, "bytes": size, "stored_bytes": stored[0], "seconds": duration}
+
+    def upload_files(self, files, max_workers=4, resume=True, compression=None):
+        """
+        Upload several files concurrently, each element of files is a localFile
+        or a (localFile, targetFile) tuple as accepted by upload_file
+        """
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(self.upload_file, *(el if isinstance(el, (tuple, list)) else (el,)),
+                                   resume=resume, compression=compression)
+                       for el in files]
+            results = [future.result() for future in futures]
+
+        duration = time.monotonic() - start
+        total = sum(el["bytes"] for el in results)
+        print("uploaded {} files, {:.1f} MB in {:.1f} s ({:.1f} MB/s)".format(
+            len(results), total / 1e6, duration, total / 1e6 / max(duration, 1e-6)))
+
+        return results
 
     def file_info(self, remoteFile):
         """
@@ -181,13 +655,65 @@ class Databricks:
 
         return res
 
-    def download_file(self, remoteFile, targetFile=None):
+    def list_files(self, remoteDir):
+        """
+        List all files below a directory of the FileStore recursively, the paths
+        are relative to the FileStore
+        """
+        base = os.path.join("/FileStore/shared_uploads", self.user)
+        output = []
+        pending = [os.path.join(base, remoteDir)]
+        while pending:
+            path = pending.pop()
+            res = self._databricks_get("/api/2.0/dbfs/list?path={}".format(path))
+
+            if "error_code" in res:
+                raise Exception(res)
+
+            for el in res.get("files", []):
+                if el["is_dir"]:
+                    pending.append(el["path"])
+                else:
+                    output.append(dict(el, path=el["path"][len(base) + 1:]))
+
+        return output
+
+    def _read_range(self, fullPath, fd, offset, length):
+        """
+        Read a range of a DBFS file and write it at the same offset of fd, returns
+        the number of bytes received
+        """
+        end = offset + length
+        received = 0
+        while offset < end:
+            data = self._databricks_get(
+                "/api/2.0/dbfs/read?path={}&offset={}&length={}".format(fullPath, offset, end - offset))
+
+            if "error_code" in data:
+                raise Exception(data)
+            if data["bytes_read"] == 0:
+                raise Exception("Unexpected end of {} at {}".format(fullPath, offset))
+
+            block = base64.b64decode(data["data"])
+            os.pwrite(fd, block, offset)
+            offset += len(block)
+            received += len(block)
+        return received
+
+    def download_file(self, remoteFile, targetFile=None, max_workers=8, compression=None):
         """
-        Return the contents of a file.
+        Return the contents of a file or a directory.
+
+        With compression the file uploaded with the same compression is fetched,
+        i.e. remoteFile with the suffix .gz or .zst, and decompressed into targetFile.
 
         If the file does not exist, this call throws an exception with RESOURCE_DOES_NOT_EXIST.
-        If the path is a directory, the read length is negative, or if the offset is negative,
-        this call throws an exception with INVALID_PARAMETER_VALUE
+
+        The file is fetched in ranges of one block, up to max_workers ranges are
+        read concurrently and written into a preallocated temporary file, which
+        replaces targetFile once the received bytes match the file info and the
+        remote file did not change during the download. A directory is
+        downloaded recursively with its files in parallel.
 
         If no targetFile is chosen the file is placed in the local FileStore
         """
@@ -196,10 +722,33 @@ class Databricks:
         if not targetFile:
             targetFile = os.path.join(
                 "/home/admin/workflow/FileStore", remoteFile)
-            targetDir = os.path.dirname(targetFile)
-            # create folder if needed
-            if not os.path.isdir(targetDir):
-                os.makedirs(targetDir)
+
+        compression = _compression(compression)
+        if compression:
+            suffix = COMPRESSION_SUFFIX[compression]
+            start = time.monotonic()
+            res = self.download_file(remoteFile + suffix, targetFile + suffix, max_workers)
+            try:
+                decompress_file(targetFile + suffix, targetFile)
+            finally:
+                os.remove(targetFile + suffix)
+
+            duration = time.monotonic() - start
+            size = os.path.getsize(targetFile)
+            print("decompressed {} in {:.1f} s ({:.1f} MB/s), {:.2f}x".format(
+                targetFile, duration, size / 1e6 / max(duration, 1e-6), size / max(res["bytes"], 1)))
+            return dict(res, bytes=size, stored_bytes=res["bytes"], seconds=duration)
+
+        # get the file info to extract the length of the file
+        file_info = self.file_info(remoteFile)
+
+        if file_info.get("is_dir"):
+            return self.download_dir(remoteFile, targetFile, max_workers)
+
+        # create folder if needed
+        targetDir = os.path.dirname(targetFile)
+        if targetDir and not os.path.isdir(targetDir):
+            os.makedirs(targetDir, exist_ok=True)
 
         # get the full path in dbfs
         fullPath = os.path.join(
@@ -207,68 +756,295 @@ class Databricks:
 
         print("download {} => {}".format(fullPath, targetFile))
 
-        # get the file info to extract the length of the file
-        file_info = self.file_info(remoteFile)
-
-        total_read = 0
-        with open(targetFile, "wb") as f:
-            while total_read < file_info["file_size"]:
-                data = self._databricks_get(
-                    "/api/2.0/dbfs/read?path={}&offset={}".format(fullPath, total_read))
-
-                if "error_code" in data:
-                    raise Exception(data)
+        start = time.monotonic()
+        size = file_info["file_size"]
+        partFile = targetFile + ".part"
+        fd = os.open(partFile, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            ranges = [(offset, min(BLOCK_SIZE, size - offset)) for offset in range(0, size, BLOCK_SIZE)]
+            if len(ranges) <= 1 or max_workers <= 1:
+                total = sum(self._read_range(fullPath, fd, offset, length) for offset, length in ranges)
+            else:
+                with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                    futures = [pool.submit(self._read_range, fullPath, fd, offset, length)
+                               for offset, length in ranges]
+                    total = sum(future.result() for future in futures)
+
+            if total != size or os.fstat(fd).st_size != size:
+                raise Exception("Download of {} incomplete, {} of {} bytes".format(
+                    fullPath, total, size))
+
+            # the ranges are only consistent if the file did not change meanwhile
+            res = self.file_info(remoteFile)
+            if res.get("file_size") != size or res.get("modification_time") != file_info.get("modification_time"):
+                raise Exception("{} changed during the download".format(fullPath))
+        except BaseException:
+            os.close(fd)
+            os.remove(partFile)
+            raise
+        os.close(fd)
+        os.replace(partFile, targetFile)
+
+        duration = time.monotonic() - start
+        print("downloaded {} in {:.1f} s ({:.1f} MB/s)".format(
+            fullPath, duration, size / 1e6 / max(duration, 1e-6)))
+
+        return {"path": fullPath, "bytes": size, "seconds": duration}
+
+    def download_dir(self, remoteDir, targetDir=None, max_workers=8):
+        """
+        Download all files below a directory of the FileStore, up to max_workers
+        files are downloaded concurrently and their range reads share max_workers
+        """
+        if not targetDir:
+            targetDir = os.path.join(
+                "/home/admin/workflow/FileStore", remoteDir)
+
+        start = time.monotonic()
+        files = self.list_files(remoteDir)
+        prefix = len(remoteDir.rstrip("/")) + 1 if remoteDir.strip("/") else 0
+        # the range reads of the files share max_workers, so the requests in
+        # flight stay within the connection pool
+        file_workers = max(1, max_workers // max(len(files), 1))
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(self.download_file, el["path"],
+                                   os.path.join(targetDir, el["path"][prefix:]), file_workers)
+                       for el in files]
+            results = [future.result() for future in futures]
+
+        duration = time.monotonic() - start
+        total = sum(el["bytes"] for el in results)
+        print("downloaded {} files, {:.1f} MB in {:.1f} s ({:.1f} MB/s)".format(
+            len(results), total / 1e6, duration, total / 1e6 / max(duration, 1e-6)))
+
+        return results
+
+    def _remote_info(self, remotePath):
+        """
+        The infos of the files at remotePath by path relative to the FileStore, empty if it does not exist
+        """
+        fullPath = os.path.join("/FileStore/shared_uploads", self.user, remotePath)
+        res = self._databricks_get("/api/2.0/dbfs/get-status?path={}".format(fullPath))
 
-                total_read += data["bytes_read"]
+        if res.get("error_code") == "RESOURCE_DOES_NOT_EXIST":
+            return {}
+        if "error_code" in res:
+            raise Exception(res)
 
-                f.write(base64.b64decode(data["data"]))
+        if res.get("is_dir"):
+            return {el["path"]: el for el in self.list_files(remotePath)}
+        return {remotePath: dict(res, path=remotePath)}
 
-    def import_ipynb(self, localFile, targetFile):
+    def _sync_reason(self, localFile, fullPath, info):
         """
-        Import a jupyter notebook to databricks
+        Why a file has to be transferred, None if the local and the remote copy are in sync.
+        The manifest records the size, mtime and hash of both copies after each transfer,
+        by DBFS path and local file
         """
-        fullPath = self._get_fullpath(targetFile)
-        print("import {} => {}".format(localFile, fullPath))
+        manifest = self._store("manifest")
+        localFile = os.path.abspath(localFile)
+        entries = manifest.get(fullPath, {})
+        entry = entries.get(localFile)
+        if info is None:
+            return "missing remote"
+        if not os.path.isfile(localFile):
+            return "missing local"
+        if entry is None:
+            return "unknown"
+        if entry["remote_size"] != info["file_size"] or entry["remote_mtime"] != info.get("modification_time"):
+            return "remote changed"
+
+        stat = os.stat(localFile)
+        if stat.st_size != entry["size"]:
+            return "local changed"
+        if stat.st_mtime != entry["mtime"]:
+            # touched, compare the content
+            if _file_hash(localFile) != entry["sha256"]:
+                return "local changed"
+            manifest.set(fullPath, dict(entries, **{localFile: dict(entry, mtime=stat.st_mtime)}))
+        return None
+
+    def _sync_record(self, localFile, fullPath, info):
+        manifest = self._store("manifest")
+        localFile = os.path.abspath(localFile)
+        stat = os.stat(localFile)
+        manifest.set(fullPath, dict(manifest.get(fullPath, {}), **{localFile: {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "sha256": _file_hash(localFile),
+            "remote_size": info["file_size"],
+            "remote_mtime": info.get("modification_time")}}))
+
+    def _sync_report(self, report, dry_run):
+        moved = [el for el in report if el["action"] != "skip"]
+        for el in report if dry_run else moved:
+            print("{:>8} {} => {} ({})".format(el["action"], el["source"], el["target"], el["reason"]))
+        print("{}{} files to transfer ({:.1f} MB), {} unchanged".format(
+            "dry run: " if dry_run else "", len(moved),
+            sum(el["bytes"] for el in moved) / 1e6, len(report) - len(moved)))
+
+    def sync_upload(self, localPath, targetPath=None, dry_run=False, max_workers=4):
+        """
+        Upload a file or a directory, skipping files which did not change since the last transfer
 
-        with open(localFile, "rb") as f:
-            block = f.read()
-            data = base64.standard_b64encode(block).decode("utf-8")
+        If targetPath is not defined, localPath is relative to the local FileStore.
+        Returns the report of the files moved or skipped, with dry_run nothing is moved.
+        """
+        if not targetPath:
+            targetPath = localPath
+            localPath = os.path.join("/home/admin/workflow/FileStore", localPath)
 
-            res = self._databricks_post("/api/2.0/workspace/import",
-                                        {"format": "JUPYTER",
-                                         "path": fullPath,
-                                         "overwrite": True,
-                                         "content": data})
+        if os.path.isdir(localPath):
+            pairs = [(os.path.join(root, name), os.path.join(targetPath, os.path.relpath(os.path.join(root, name), localPath)))
+                     for root, dirs, files in os.walk(localPath) for name in files]
+        else:
+            pairs = [(localPath, targetPath)]
+
+        infos = self._remote_info(targetPath)
+        base = os.path.join("/FileStore/shared_uploads", self.user)
+        report = []
+        for localFile, targetFile in pairs:
+            reason = self._sync_reason(localFile, os.path.join(base, targetFile), infos.get(targetFile))
+            report.append({"action": "upload" if reason else "skip", "source": localFile,
+                           "target": targetFile, "bytes": os.path.getsize(localFile), "reason": reason})
+
+        self._sync_report(report, dry_run)
+        if not dry_run:
+            def upload(el):
+                res = self.upload_file(el["source"], el["target"])
+                self._sync_record(el["source"], res["path"], self.file_info(el["target"]))
+
+            try:
+                with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                    for future in [pool.submit(upload, el) for el in report if el["action"] != "skip"]:
+                        future.result()
+            finally:
+                self._store("manifest").save()
+
+        return report
+
+    def sync_download(self, remotePath, targetPath=None, dry_run=False, max_workers=8):
+        """
+        Download a file or a directory, skipping files which did not change since the last transfer
 
+        If targetPath is not defined, the files are placed in the local FileStore.
+        Returns the report of the files moved or skipped, with dry_run nothing is moved.
+        """
+        if not targetPath:
+            targetPath = os.path.join("/home/admin/workflow/FileStore", remotePath)
+
+        infos = self._remote_info(remotePath)
+        if not infos:
+            raise Exception("{} not found in the FileStore".format(remotePath))
+
+        base = os.path.join("/FileStore/shared_uploads", self.user)
+        prefix = len(remotePath.rstrip("/")) + 1 if remotePath.strip("/") else 0
+        report = []
+        for remoteFile, info in sorted(infos.items()):
+            localFile = targetPath if remoteFile == remotePath else os.path.join(targetPath, remoteFile[prefix:])
+            reason = self._sync_reason(localFile, os.path.join(base, remoteFile), info)
+            report.append({"action": "download" if reason else "skip", "source": remoteFile,
+                           "target": localFile, "bytes": info["file_size"], "reason": reason, "info": info})
+
+        self._sync_report(report, dry_run)
+        if not dry_run:
+            # the range reads of the files share max_workers like in download_dir
+            file_workers = max(1, max_workers // max(sum(el["action"] != "skip" for el in report), 1))
+
+            def download(el):
+                res = self.download_file(el["source"], el["target"], file_workers)
+                self._sync_record(el["target"], res["path"], el["info"])
+
+            try:
+                with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                    for future in [pool.submit(download, el) for el in report if el["action"] != "skip"]:
+                        future.result()
+            finally:
+                self._store("manifest").save()
+
+        for el in report:
+            del el["info"]
+        return report
+
+    def _workspace_status(self, fullPath):
+        """
+        The workspace metadata of a path, None if it does not exist
+        """
+        res = self._databricks_get(
+            "/api/2.0/workspace/get-status?path={}".format(fullPath))
+
+        if res.get("error_code") == "RESOURCE_DOES_NOT_EXIST":
+            return None
         if "error_code" in res:
             raise Exception(res)
+        return res
 
-    def import_py(self, localFile, targetFile):
+    def _import(self, localFile, targetFile, body, skip_unchanged=False):
         """
-        Import a plain python file into databricks
+        Import a file into the workspace, returns False if the import was skipped
+
+        With skip_unchanged the import is skipped when the content matches the last
+        import from here and the workspace object was not replaced or modified since.
+        A missing parent folder is created and the import retried.
         """
         fullPath = self._get_fullpath(targetFile)
-        print("import {} => {}".format(localFile, fullPath))
 
         with open(localFile, "rb") as f:
             block = f.read()
-            data = base64.standard_b64encode(block).decode("utf-8")
+        content_hash = hashlib.sha256(block).hexdigest()
 
-            res = self._databricks_post("/api/2.0/workspace/import",
-                                        {"format": "SOURCE",
-                                         "language": "PYTHON",
-                                         "path": fullPath,
-                                         "overwrite": True,
-                                         "content": data})
+        imports = self._store("imports")
+        entry = imports.get(fullPath)
+        if skip_unchanged and entry is not None and entry["sha256"] == content_hash:
+            status = self._workspace_status(fullPath)
+            if status is not None and status.get("object_id") == entry["object_id"] \
+                    and status.get("modified_at") == entry["modified_at"]:
+                print("import {} => {} unchanged".format(localFile, fullPath))
+                return False
+
+        print("import {} => {}".format(localFile, fullPath))
+        data = base64.standard_b64encode(block).decode("utf-8")
+        body = dict(body, path=fullPath, overwrite=True, content=data)
+        res = self._databricks_post("/api/2.0/workspace/import", body)
+
+        if res.get("error_code") == "RESOURCE_DOES_NOT_EXIST":
+            self.mkdirs(os.path.dirname(targetFile))
+            res = self._databricks_post("/api/2.0/workspace/import", body)
 
         if "error_code" in res:
             raise Exception(res)
 
-    def mkdirs(self, folder):
+        status = self._workspace_status(fullPath) or {}
+        imports.set(fullPath, {"sha256": content_hash,
+                               "object_id": status.get("object_id"),
+                               "modified_at": status.get("modified_at")})
+        imports.save()
+        return True
+
+    def import_ipynb(self, localFile, targetFile, skip_unchanged=False):
+        """
+        Import a jupyter notebook to databricks
+        """
+        return self._import(localFile, targetFile, {"format": "JUPYTER"}, skip_unchanged)
+
+    def import_py(self, localFile, targetFile, skip_unchanged=False):
+        """
+        Import a plain python file into databricks
+        """
+        return self._import(localFile, targetFile, {"format": "SOURCE", "language": "PYTHON"}, skip_unchanged)
+
+    def mkdirs(self, folder, skip_existing=False):
         """
         Create the given directory and necessary parent directories if they do not exists.
+
+        With skip_existing folders created before from here are not created again.
         """
         fullPath = self._get_fullpath(folder)
+        folders = self._store("folders")
+        if skip_existing and folders.get(fullPath):
+            return
+
         print("mkdir {}".format(fullPath))
         res = self._databricks_post(
             "/api/2.0/workspace/mkdirs", {"path": fullPath})
@@ -276,19 +1052,33 @@ class Databricks:
         if "error_code" in res:
             raise Exception(res)
 
+        folders.set(fullPath, True)
+        folders.save()
+
+    def _iter_jobs(self):
+        """
+        Iterate over all jobs, page by page
+        """
+        offset = 0
+        while True:
+            res = self._databricks_get(
+                "/api/2.0/jobs/list?limit=25&offset={}".format(offset))
+
+            if "error_code" in res:
+                raise Exception(res)
+
+            jobs = res.get("jobs", [])
+            for el in jobs:
+                yield el
+            if not jobs or not res.get("has_more"):
+                return
+            offset += len(jobs)
+
     def list_jobs(self, all=False):
         """
         List all jobs.
         """
-        res = self._databricks_get("/api/2.0/jobs/list")
-
-        if "jobs" in res:
-            if all:
-                return res["jobs"]
-            else:
-                return [el for el in res["jobs"] if el["creator_user_name"] == self.user]
-        else:
-            raise Exception(res)
+        return [el for el in self._iter_jobs() if all or el.get("creator_user_name") == self.user]
 
     def delete_job(self, job_id):
         """
@@ -317,38 +1107,83 @@ class Databricks:
             raise Exception(res)
         return res
 
+    def _index_jobs(self):
+        """
+        Rebuild the local index of notebook path to job_id from the paged job list
+        """
+        index = self._store("jobs")
+        found = {}
+        for el in self.list_jobs():
+            path = el.get("settings", {}).get("notebook_task", {}).get("notebook_path")
+            if path:
+                found.setdefault(path, []).append(el["job_id"])
+
+        for path, entry in list(index.data.items()):
+            if path not in found:
+                index.delete(path)
+        for path, job_ids in found.items():
+            entry = index.get(path, {})
+            if entry.get("job_ids") != job_ids:
+                index.set(path, {"job_ids": job_ids, "settings_hash": None})
+        index.save()
+        return found
+
     def assure_job(self, name, targetFile, new_cluster=None, existing_cluster_id=None, libraries=None):
         """
         Create or update a job setting. The job is selected based on the target file
+
+        A local index maps the notebook path to the job_id and the hash of the deployed
+        settings, the job list is only read when the index does not know the notebook.
+        The reset is skipped if the settings are unchanged.
         """
         fullPath = self._get_fullpath(targetFile)
 
-        # check existing jobs
-        jobs = [el for el in self.list_jobs() if "settings" in el and "notebook_task" in el["settings"]
-                and "notebook_path" in el["settings"]["notebook_task"]
-                and el["settings"]["notebook_task"]["notebook_path"] == fullPath]
-
-        if len(jobs) > 1:
-            raise Exception(
-                "Too many jobs based on notebook {}".format(fullPath))
-
         # create the job configuration
         new_job = self._get_job_config(
             name, fullPath, new_cluster=new_cluster,
             existing_cluster_id=existing_cluster_id,
             libraries=libraries)
+        settings_hash = hashlib.sha256(json.dumps(new_job, sort_keys=True).encode("utf-8")).hexdigest()
+
+        index = self._store("jobs")
+        entry = index.get(fullPath)
+        deployed = None
+        if entry is not None and len(entry["job_ids"]) == 1:
+            deployed = self._databricks_get(
+                "/api/2.0/jobs/get?job_id={}".format(entry["job_ids"][0]))
+            if "error_code" in deployed or \
+                    deployed.get("settings", {}).get("notebook_task", {}).get("notebook_path") != fullPath:
+                # deleted or changed in the workspace
+                deployed = None
+                entry = None
+
+        # unknown notebooks and cached duplicates are checked against the job list,
+        # a duplicate may have been deleted in the workspace meanwhile
+        if entry is None or len(entry["job_ids"]) != 1:
+            entry = {"job_ids": self._index_jobs().get(fullPath, []), "settings_hash": None}
+
+        if len(entry["job_ids"]) > 1:
+            raise Exception(
+                "Too many jobs based on notebook {}".format(fullPath))
 
         # create or update the job
-        if len(jobs) == 0:
+        if len(entry["job_ids"]) == 0:
             res = self._databricks_post("/api/2.0/jobs/create", new_job)
+        elif entry["settings_hash"] == settings_hash and deployed is not None \
+                and _contains(_normalized(deployed.get("settings", {})), _normalized(new_job)):
+            print("job {} is up to date".format(entry["job_ids"][0]))
+            return {"job_id": entry["job_ids"][0]}
         else:
             res = self._databricks_post(
-                "/api/2.0/jobs/reset", {"job_id": jobs[0]["job_id"], "new_settings": new_job})
+                "/api/2.0/jobs/reset", {"job_id": entry["job_ids"][0], "new_settings": new_job})
             if not "job_id" in res:
-                res["job_id"] = jobs[0]["job_id"]
+                res["job_id"] = entry["job_ids"][0]
 
         if "error_code" in res:
             raise Exception(res)
+
+        index.set(fullPath, {"job_ids": [res["job_id"]], "settings_hash": settings_hash})
+        index.save()
         return res
 
     def run_job(self, job_id, params={}):
@@ -385,6 +1220,12 @@ class Databricks:
         if "error_code" in res:
             raise Exception(res)
 
+        self._export_views(res, fileName)
+
+    def _export_views(self, res, fileName):
+        """
+        Helper to write the views of a run export as HTML files
+        """
         if "views" in res:
             count = 1
             for d in res["views"]:
@@ -408,19 +1249,112 @@ class Databricks:
                 display(HTML("<H3>{} - {}</H3>".format(d["name"], d["type"])))
                 display(_DatabricksIFrame(d["content"]))
 
-    def await_run(self, run_id, delay=120):
+    def _poll_delay(self, age, delay=None):
+        """
+        Delay until the next status poll of a run that is running since age seconds
+        """
+        if delay is not None:
+            return delay
+        return min(max(age * self.poll_factor, self.poll_min_delay), self.poll_max_delay)
+
+    def _run_age(self, res):
+        start = res.get("start_time")
+        return max(0.0, time.time() - start / 1000) if start else 0.0
+
+    def _detection_lag(self, res):
+        """
+        Seconds between the end of a run and now, None while it has no end time
+        """
+        end = res.get("end_time")
+        return max(0.0, time.time() - end / 1000) if end else None
+
+    def _run_finished(self, res, polled=False):
+        """
+        Check if a run reached a final state. If it was found after a poll delay,
+        record how late it was noticed, runs finished at the first check say
+        nothing about the delay
+        """
+        if res.get("state", {}).get("life_cycle_state") not in TERMINAL_STATES:
+            return False
+        lag = self._detection_lag(res)
+        if polled and lag is not None:
+            run_detection_lag.labels().observe(lag)
+        return True
+
+    def await_run(self, run_id, delay=None):
         """
         Wait until the job with run_id is finished
+
+        Young runs are polled quickly, the delay grows with the age of the run from
+        POLL_MIN_DELAY up to POLL_MAX_DELAY. A fixed delay in seconds disables this.
         """
 
         res = self.run_status(run_id)
+        polled = False
 
-        while (not "state" in res) or (not "life_cycle_state" in res["state"]) or (res["state"]["life_cycle_state"] != "TERMINATED"):
-            time.sleep(delay)
+        while not self._run_finished(res, polled):
+            time.sleep(self._poll_delay(self._run_age(res), delay))
             res = self.run_status(run_id)
+            polled = True
 
+        lag = self._detection_lag(res)
+        if polled and lag is not None:
+            print("run {} finished, noticed {:.1f} s after its end".format(run_id, lag))
+            res["detection_lag"] = lag
         return res
 
+    def _active_runs(self, job_id):
+        """
+        The ids of the active runs of a job
+        """
+        output = set()
+        offset = 0
+        while True:
+            res = self._databricks_get(
+                "/api/2.0/jobs/runs/list?job_id={}&active_only=true&offset={}&limit=25".format(job_id, offset))
+
+            if "error_code" in res:
+                raise Exception(res)
+
+            runs = res.get("runs", [])
+            output.update(el["run_id"] for el in runs)
+            if not runs or not res.get("has_more"):
+                return output
+            offset += len(runs)
+
+    def await_runs(self, run_ids, delay=None):
+        """
+        Wait until all runs are finished and return their metadata by run_id
+
+        Each poll lists the active runs once per job instead of getting every run,
+        only the runs which left the active list are fetched again.
+        """
+        pending = {}
+        output = {}
+        for run_id in run_ids:
+            res = self.run_status(run_id)
+            if self._run_finished(res):
+                output[run_id] = res
+            else:
+                pending[run_id] = res
+
+        while pending:
+            time.sleep(self._poll_delay(
+                min(self._run_age(res) for res in pending.values()), delay))
+
+            active = set()
+            for job_id in {res["job_id"] for res in pending.values() if "job_id" in res}:
+                active |= self._active_runs(job_id)
+
+            for run_id in [el for el in pending if int(el) not in active]:
+                res = self.run_status(run_id)
+                if self._run_finished(res, polled=True):
+                    output[run_id] = res
+                    del pending[run_id]
+                else:
+                    pending[run_id] = res
+
+        return {run_id: output[run_id] for run_id in run_ids}
 
     def terminate_cluster(self, existing_cluster_id):
         """
@@ -429,4 +1363,246 @@ class Databricks:
 
         res = self._databricks_post("/api/2.0/clusters/delete", {"cluster_id": existing_cluster_id})
 
-        return res
\ No newline at end of file
+        return res
+
+    def cluster_status(self, cluster_id):
+        """
+        Retrieve the information of a cluster, None if it does not exist
+        """
+        res = self._databricks_get(
+            "/api/2.0/clusters/get?cluster_id={}".format(cluster_id))
+
+        if res.get("error_code") in ("RESOURCE_DOES_NOT_EXIST", "INVALID_PARAMETER_VALUE"):
+            return None
+        if "error_code" in res:
+            raise Exception(res)
+        return res
+
+    def create_cluster(self, spec):
+        """
+        Create and start an all-purpose cluster, returns the cluster_id
+        """
+        res = self._databricks_post("/api/2.0/clusters/create", spec)
+
+        if "error_code" in res:
+            raise Exception(res)
+        return res["cluster_id"]
+
+    def start_cluster(self, cluster_id):
+        """
+        Start a terminated cluster
+        """
+        res = self._databricks_post("/api/2.0/clusters/start", {"cluster_id": cluster_id})
+
+        if "error_code" in res:
+            raise Exception(res)
+
+    def await_cluster(self, cluster_id):
+        """
+        Wait until a cluster is running
+        """
+        start = time.monotonic()
+        while True:
+            res = self.cluster_status(cluster_id)
+            state = res.get("state") if res else None
+            if state == "RUNNING":
+                return res
+            if state not in ("PENDING", "RESTARTING", "RESIZING"):
+                raise Exception("Cluster {} is {}".format(cluster_id, state))
+            time.sleep(self._poll_delay(time.monotonic() - start))
+
+
+class ClusterPool(object):
+    """
+    Lease warm all-purpose clusters to tasks
+
+    Each cluster spec of a scope, e.g. a DAG run, gets up to size clusters. A task
+    acquires a free running cluster of its spec, restarts a terminated one or
+    creates a new one while the pool is not full, otherwise it waits until another
+    task releases one. Released clusters stay up and are terminated once they were
+    idle for idle_timeout seconds, as a safety net the clusters also auto-terminate
+    in Databricks. The leases are kept in a JSON file in the state folder under a
+    file lock, so tasks in different processes share the pool.
+
+    A lease records the host and pid of its process and a heartbeat, which a thread
+    renews while the lease is held. Leases of dead processes on the same host or
+    without a heartbeat for lease_timeout seconds return to the pool, a retry of
+    the same owner takes its cluster back right away.
+    """
+
+    def __init__(self, dbr, size=1, idle_timeout=600, scope="", lease_timeout=600):
+        self.dbr = dbr
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.scope = scope
+        self.lease_timeout = lease_timeout
+        self.path = os.path.join(dbr.state_dir, "clusters.json")
+        self.host = socket.gethostname()
+        self.leases = {}
+        self.timings = {}
+        self._heartbeats = {}
+
+    @contextlib.contextmanager
+    def _state(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.path) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = {}
+
+            yield state
+
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(state, f)
+            os.replace(self.path + ".tmp", self.path)
+
+    def _key(self, spec):
+        return "{}:{}".format(self.scope, hashlib.sha256(
+            json.dumps(spec, sort_keys=True).encode("utf-8")).hexdigest()[:16])
+
+    def _stale(self, el, now):
+        """
+        Check if the process holding a lease is gone
+        """
+        if now - el.get("heartbeat", el["leased"]) > self.lease_timeout:
+            return True
+        if el.get("host") != self.host or not el.get("pid"):
+            return False
+        try:
+            os.kill(el["pid"], 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    def _reap(self, state):
+        """
+        Return the leases of dead processes and terminate the clusters of all pools
+        which were idle for longer than idle_timeout
+        """
+        now = time.time()
+        for key, pool in list(state.items()):
+            for cluster_id, el in list(pool.items()):
+                if el["owner"] is not None and self._stale(el, now):
+                    print("reclaim cluster {} of {}".format(cluster_id, el["owner"]))
+                    el.update(owner=None, last_used=el.get("heartbeat", el["leased"]))
+                if el["owner"] is None and now - el["last_used"] > self.idle_timeout:
+                    print("terminate idle cluster {}".format(cluster_id))
+                    self.dbr.terminate_cluster(cluster_id)
+                    del pool[cluster_id]
+            if not pool:
+                del state[key]
+
+    def _lease(self, spec, owner):
+        """
+        Lease a cluster of the spec in a single locked step, None if the pool is exhausted
+        """
+        key = self._key(spec)
+        lease = {"owner": owner, "host": self.host, "pid": os.getpid()}
+        with self._state() as state:
+            self._reap(state)
+            pool = state.setdefault(key, {})
+
+            # a retry of the owner, e.g. after its worker died, takes its cluster back first
+            for cluster_id, el in sorted(pool.items(), key=lambda item: item[1]["owner"] != owner):
+                if el["owner"] not in (None, owner):
+                    continue
+                res = self.dbr.cluster_status(cluster_id)
+                cluster_state = res.get("state") if res else None
+                if cluster_state in ("TERMINATED", "TERMINATING"):
+                    self.dbr.start_cluster(cluster_id)
+                elif cluster_state not in ("RUNNING", "PENDING", "RESTARTING", "RESIZING"):
+                    del pool[cluster_id]
+                    continue
+                el.update(lease, leased=time.time(), heartbeat=time.time())
+                return cluster_id
+
+            if len(pool) < self.size:
+                spec = dict(spec,
+                            cluster_name="afhub-pool-{}".format(key.rsplit(":", 1)[1]),
+                            autotermination_minutes=max(10, int(self.idle_timeout // 60) + 1))
+                cluster_id = self.dbr.create_cluster(spec)
+                pool[cluster_id] = dict(lease, leased=time.time(), heartbeat=time.time(),
+                                        last_used=time.time())
+                return cluster_id
+
+    def _owns(self, el):
+        return el["owner"] is not None and el.get("host") == self.host and el.get("pid") == os.getpid()
+
+    def _heartbeat(self, cluster_id, stop):
+        """
+        Renew the heartbeat of a lease until it is released
+        """
+        while not stop.wait(self.lease_timeout / 4):
+            with self._state() as state:
+                for pool in state.values():
+                    if cluster_id in pool and self._owns(pool[cluster_id]):
+                        pool[cluster_id]["heartbeat"] = time.time()
+
+    def acquire(self, spec, owner, timeout=3600):
+        """
+        Lease a running cluster of the spec, returns its cluster_id
+        """
+        start = time.monotonic()
+        while True:
+            cluster_id = self._lease(spec, owner)
+            if cluster_id is not None:
+                break
+            if time.monotonic() - start > timeout:
+                raise Exception("No cluster of the pool got free within {} s".format(timeout))
+            time.sleep(self.dbr._poll_delay(time.monotonic() - start))
+
+        stop = threading.Event()
+        self._heartbeats[cluster_id] = stop
+        threading.Thread(target=self._heartbeat, args=(cluster_id, stop), daemon=True).start()
+
+        try:
+            self.dbr.await_cluster(cluster_id)
+        except Exception:
+            self.release(cluster_id)
+            raise
+
+        wait = time.monotonic() - start
+        cluster_wait.labels().observe(wait)
+        self.timings[cluster_id] = {"wait_seconds": wait}
+        self.leases[cluster_id] = time.monotonic()
+        print("leased cluster {} after {:.0f} s".format(cluster_id, wait))
+        return cluster_id
+
+    def release(self, cluster_id):
+        """
+        Return a cluster to the pool, it stays up until it was idle for idle_timeout
+        """
+        if cluster_id in self._heartbeats:
+            self._heartbeats.pop(cluster_id).set()
+
+        with self._state() as state:
+            for pool in state.values():
+                # the lease may already be reclaimed by a retry of the owner
+                if cluster_id in pool and self._owns(pool[cluster_id]):
+                    pool[cluster_id].update(owner=None, last_used=time.time())
+            self._reap(state)
+
+        if cluster_id in self.leases:
+            duration = time.monotonic() - self.leases.pop(cluster_id)
+            cluster_lease.labels().observe(duration)
+            self.timings.setdefault(cluster_id, {})["lease_seconds"] = duration
+            print("released cluster {} after {:.0f} s".format(cluster_id, duration))
+
+    def stats(self):
+        """
+        Histograms of the wait for a cluster and of the lease durations
+        """
+        return {"cluster_wait": cluster_wait.labels().to_dict(),
+                "cluster_lease": cluster_lease.labels().to_dict()}
+
+    def reap(self):
+        """
+        Terminate the idle clusters of all pools
+        """
+        with self._state() as state:
+            self._reap(state)
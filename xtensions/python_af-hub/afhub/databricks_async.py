@@ -0,0 +1,393 @@
+import json
+import base64
+import asyncio
+import os
+import time
+
+from .databricks import Databricks, BLOCK_SIZE, RETRY_STATUS, UNSAFE_ACTIONS, request_latency, request_retries
+
+
+class AsyncDatabricks:
+    """
+    An asyncio interface to Databricks with the method surface of the Databricks class
+
+    One instance drives many uploads, job submissions and status polls concurrently
+    over a single aiohttp session, at most max_concurrency API calls are in flight.
+    The configuration, retries and metrics are shared with the Databricks class.
+
+    Use it as async context manager or call close() when done:
+
+        async with AsyncDatabricks() as dbr:
+            runs = await asyncio.gather(*[dbr.run_job(job_id) for job_id in jobs])
+    """
+
+    def __init__(self, max_concurrency=16):
+        self.client = Databricks()
+        self.user = self.client.user
+        self.mlflow = self.client.mlflow
+        self.max_concurrency = max_concurrency
+        self._session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        """
+        Create the session and the semaphore in the running event loop
+        """
+        import aiohttp
+
+        if self._session is None:
+            timeout = aiohttp.ClientTimeout(
+                sock_connect=self.client.timeout[0], sock_read=self.client.timeout[1])
+            self._session = aiohttp.ClientSession(
+                headers={'Authorization': 'Bearer %s' % self.client.token},
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                timeout=timeout)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._session
+
+    async def _databricks_request(self, method, action, body=None):
+        """
+        Make a databricks API request, retried like Databricks._databricks_request
+        """
+        import aiohttp
+
+        session = self._get_session()
+        endpoint = action.split("?")[0]
+        safe = method == "GET" or endpoint not in UNSAFE_ACTIONS
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                async with self._semaphore:
+                    async with session.request(method, self.client.registry + action, json=body) as response:
+                        text = await response.text()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as ex:
+                request_latency.labels(endpoint).observe(time.monotonic() - start)
+                retry = isinstance(ex, aiohttp.ClientConnectorError) or safe
+                if not retry or attempt >= self.client.max_retries:
+                    raise
+                request_retries.labels(endpoint, type(ex).__name__).inc()
+                await asyncio.sleep(self.client._retry_delay(attempt))
+                attempt += 1
+                continue
+
+            request_latency.labels(endpoint).observe(time.monotonic() - start)
+            retry = response.status == 429 or (safe and response.status in RETRY_STATUS)
+            if not retry or attempt >= self.client.max_retries:
+                break
+            request_retries.labels(endpoint, str(response.status)).inc()
+            await asyncio.sleep(self.client._retry_delay(attempt, response))
+            attempt += 1
+
+        try:
+            return json.loads(text)
+        except ValueError:
+            return {"error_code": str(response.status), "message": text}
+
+    async def _databricks_post(self, action, body):
+        res = await self._databricks_request("POST", action, body)
+        if "error_code" in res:
+            raise Exception(res)
+        return res
+
+    async def _databricks_get(self, action):
+        res = await self._databricks_request("GET", action)
+        if "error_code" in res:
+            raise Exception(res)
+        return res
+
+    def _get_fullpath(self, fileName):
+        return self.client._get_fullpath(fileName)
+
+    async def _gather_files(self, transfers):
+        """
+        Run file transfers concurrently, at most max_concurrency at a time, so the
+        number of open local files stays bounded for large directories
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def run(transfer):
+            async with semaphore:
+                return await transfer
+
+        return await asyncio.gather(*[run(transfer) for transfer in transfers])
+
+    async def upload_file(self, localFile, targetFile=None):
+        """
+        Upload a data file to the FileStore, the next block is read and encoded
+        in a thread while the current one is sent
+        """
+        localFile, fullPath = self.client._upload_paths(localFile, targetFile)
+        print("upload {} => {}".format(localFile, fullPath))
+
+        loop = asyncio.get_event_loop()
+        start = time.monotonic()
+        size = os.path.getsize(localFile)
+
+        with open(localFile, "rb") as f:
+            def encode():
+                return base64.standard_b64encode(f.read(BLOCK_SIZE)).decode("utf-8")
+
+            if size <= BLOCK_SIZE:
+                data = await loop.run_in_executor(None, encode)
+                await self._databricks_post(
+                    "/api/2.0/dbfs/put", {"path": fullPath, "contents": data, "overwrite": True})
+            else:
+                res = await self._databricks_post(
+                    "/api/2.0/dbfs/create", {"path": fullPath, "overwrite": "true"})
+                handle = res['handle']
+
+                data = await loop.run_in_executor(None, encode)
+                while data:
+                    following = loop.run_in_executor(None, encode)
+                    try:
+                        await self._databricks_post(
+                            "/api/2.0/dbfs/add-block", {"handle": handle, "data": data})
+                    finally:
+                        data = await following
+
+                await self._databricks_post("/api/2.0/dbfs/close", {"handle": handle})
+
+        duration = time.monotonic() - start
+        print("uploaded {} in {:.1f} s ({:.1f} MB/s)".format(
+            fullPath, duration, size / 1e6 / max(duration, 1e-6)))
+
+        return {"path": fullPath, "bytes": size, "seconds": duration}
+
+    async def upload_files(self, files):
+        """
+        Upload several files concurrently, see Databricks.upload_files
+        """
+        return await self._gather_files([
+            self.upload_file(*(el if isinstance(el, (tuple, list)) else (el,))) for el in files])
+
+    async def file_info(self, remoteFile):
+        """
+        Get the file information of a file or directory
+        """
+        fullPath = os.path.join(
+            "/FileStore/shared_uploads", self.user, remoteFile)
+        return await self._databricks_get(
+            "/api/2.0/dbfs/get-status?path={}".format(fullPath))
+
+    async def list_files(self, remoteDir):
+        """
+        List all files below a directory of the FileStore recursively
+        """
+        base = os.path.join("/FileStore/shared_uploads", self.user)
+        output = []
+        pending = [os.path.join(base, remoteDir)]
+        while pending:
+            results = await asyncio.gather(*[
+                self._databricks_get("/api/2.0/dbfs/list?path={}".format(path)) for path in pending])
+            pending = []
+            for res in results:
+                for el in res.get("files", []):
+                    if el["is_dir"]:
+                        pending.append(el["path"])
+                    else:
+                        output.append(dict(el, path=el["path"][len(base) + 1:]))
+
+        return output
+
+    async def _read_range(self, fullPath, fd, offset, length):
+        end = offset + length
+        received = 0
+        while offset < end:
+            data = await self._databricks_get(
+                "/api/2.0/dbfs/read?path={}&offset={}&length={}".format(fullPath, offset, end - offset))
+            if data["bytes_read"] == 0:
+                raise Exception("Unexpected end of {} at {}".format(fullPath, offset))
+
+            block = base64.b64decode(data["data"])
+            os.pwrite(fd, block, offset)
+            offset += len(block)
+            received += len(block)
+        return received
+
+    async def download_file(self, remoteFile, targetFile=None):
+        """
+        Download a file or a directory, all ranges are read concurrently
+        """
+        if not targetFile:
+            targetFile = os.path.join(
+                "/home/admin/workflow/FileStore", remoteFile)
+
+        file_info = await self.file_info(remoteFile)
+
+        if file_info.get("is_dir"):
+            files = await self.list_files(remoteFile)
+            prefix = len(remoteFile.rstrip("/")) + 1 if remoteFile.strip("/") else 0
+            return await self._gather_files([
+                self.download_file(el["path"], os.path.join(targetFile, el["path"][prefix:]))
+                for el in files])
+
+        targetDir = os.path.dirname(targetFile)
+        if targetDir and not os.path.isdir(targetDir):
+            os.makedirs(targetDir, exist_ok=True)
+
+        fullPath = os.path.join(
+            "/FileStore/shared_uploads", self.user, remoteFile)
+        print("download {} => {}".format(fullPath, targetFile))
+
+        start = time.monotonic()
+        size = file_info["file_size"]
+        partFile = targetFile + ".part"
+        fd = os.open(partFile, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            total = sum(await asyncio.gather(*[
+                self._read_range(fullPath, fd, offset, min(BLOCK_SIZE, size - offset))
+                for offset in range(0, size, BLOCK_SIZE)]))
+
+            if total != size or os.fstat(fd).st_size != size:
+                raise Exception("Download of {} incomplete, {} of {} bytes".format(
+                    fullPath, total, size))
+
+            res = await self.file_info(remoteFile)
+            if res.get("file_size") != size or res.get("modification_time") != file_info.get("modification_time"):
+                raise Exception("{} changed during the download".format(fullPath))
+        except BaseException:
+            os.close(fd)
+            os.remove(partFile)
+            raise
+        os.close(fd)
+        os.replace(partFile, targetFile)
+
+        duration = time.monotonic() - start
+        print("downloaded {} in {:.1f} s ({:.1f} MB/s)".format(
+            fullPath, duration, size / 1e6 / max(duration, 1e-6)))
+
+        return {"path": fullPath, "bytes": size, "seconds": duration}
+
+    async def _import(self, localFile, targetFile, body):
+        fullPath = self._get_fullpath(targetFile)
+        print("import {} => {}".format(localFile, fullPath))
+
+        with open(localFile, "rb") as f:
+            data = base64.standard_b64encode(f.read()).decode("utf-8")
+
+        await self._databricks_post("/api/2.0/workspace/import",
+                                    dict(body, path=fullPath, overwrite=True, content=data))
+
+    async def import_ipynb(self, localFile, targetFile):
+        """
+        Import a jupyter notebook to databricks
+        """
+        await self._import(localFile, targetFile, {"format": "JUPYTER"})
+
+    async def import_py(self, localFile, targetFile):
+        """
+        Import a plain python file into databricks
+        """
+        await self._import(localFile, targetFile, {"format": "SOURCE", "language": "PYTHON"})
+
+    async def mkdirs(self, folder):
+        """
+        Create the given directory and necessary parent directories if they do not exists.
+        """
+        fullPath = self._get_fullpath(folder)
+        print("mkdir {}".format(fullPath))
+        await self._databricks_post("/api/2.0/workspace/mkdirs", {"path": fullPath})
+
+    async def list_jobs(self, all=False):
+        """
+        List all jobs, page by page like Databricks.list_jobs
+        """
+        output = []
+        offset = 0
+        while True:
+            res = await self._databricks_get(
+                "/api/2.0/jobs/list?limit=25&offset={}".format(offset))
+
+            jobs = res.get("jobs", [])
+            output.extend(el for el in jobs if all or el.get("creator_user_name") == self.user)
+            if not jobs or not res.get("has_more"):
+                return output
+            offset += len(jobs)
+
+    async def assure_job(self, name, targetFile, new_cluster=None, existing_cluster_id=None, libraries=None):
+        """
+        Create or update a job setting. The job is selected based on the target file
+        """
+        fullPath = self._get_fullpath(targetFile)
+
+        jobs = [el for el in await self.list_jobs()
+                if el.get("settings", {}).get("notebook_task", {}).get("notebook_path") == fullPath]
+
+        if len(jobs) > 1:
+            raise Exception(
+                "Too many jobs based on notebook {}".format(fullPath))
+
+        new_job = self.client._get_job_config(
+            name, fullPath, new_cluster=new_cluster,
+            existing_cluster_id=existing_cluster_id,
+            libraries=libraries)
+
+        if len(jobs) == 0:
+            return await self._databricks_post("/api/2.0/jobs/create", new_job)
+
+        res = await self._databricks_post(
+            "/api/2.0/jobs/reset", {"job_id": jobs[0]["job_id"], "new_settings": new_job})
+        if not "job_id" in res:
+            res["job_id"] = jobs[0]["job_id"]
+        return res
+
+    async def run_job(self, job_id, params={}):
+        """
+        Run a job now and return the run_id of the triggered run.
+        """
+        return await self._databricks_post(
+            "/api/2.0/jobs/run-now", {"job_id": job_id, "notebook_params": params})
+
+    async def run_status(self, run_id):
+        """
+        Retrieve the metadata of a run.
+        """
+        return await self._databricks_get(
+            "/api/2.0/jobs/runs/get?run_id={}".format(run_id))
+
+    async def run_export(self, run_id, fileName):
+        """
+        Retrieve the job run task and export the HTML file.
+        """
+        res = await self._databricks_get(
+            "/api/2.0/jobs/runs/export?run_id={}".format(run_id))
+        self.client._export_views(res, fileName)
+
+    async def await_run(self, run_id, delay=None):
+        """
+        Wait until the job with run_id is finished, other tasks keep running meanwhile.
+        The polls back off like Databricks.await_run
+        """
+        res = await self.run_status(run_id)
+        polled = False
+
+        while not self.client._run_finished(res, polled):
+            await asyncio.sleep(self.client._poll_delay(self.client._run_age(res), delay))
+            res = await self.run_status(run_id)
+            polled = True
+
+        lag = self.client._detection_lag(res)
+        if polled and lag is not None:
+            print("run {} finished, noticed {:.1f} s after its end".format(run_id, lag))
+            res["detection_lag"] = lag
+        return res
+
+    async def terminate_cluster(self, existing_cluster_id):
+        """
+        Stop a job cluster
+        """
+        return await self._databricks_request(
+            "POST", "/api/2.0/clusters/delete", {"cluster_id": existing_cluster_id})
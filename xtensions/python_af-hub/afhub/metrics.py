@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Lightweight metric primitives used by the af-hub services"""
+
+import threading
+
+
+class Histogram:
+    """
+    A thread safe histogram with fixed bucket boundaries
+
+    The buckets are cumulative upper bounds, the last implicit bucket is +Inf.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counts = [0] * (len(self.buckets) + 1)
+            self.sum = 0.0
+            self.count = 0
+
+    def observe(self, value):
+        idx = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                idx = i
+                break
+        with self._lock:
+            self.counts[idx] += 1
+            self.sum += value
+            self.count += 1
+
+    def to_dict(self):
+        """
+        Return a snapshot of the histogram with cumulative bucket counts
+        """
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+            count = self.count
+
+        buckets = {}
+        cumulative = 0
+        for bound, c in zip(self.buckets + ["+Inf"], counts):
+            cumulative += c
+            buckets[str(bound)] = cumulative
+
+        return {"buckets": buckets, "sum": total, "count": count}
+
+
+class Value:
+    """
+    A thread safe number used as counter or gauge
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+
+class Family:
+    """
+    A named metric with one child per combination of label values
+    """
+
+    def __init__(self, name, documentation, kind, labelnames=(), buckets=None):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        self.children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self.children.get(values)
+        if child is None:
+            with self._lock:
+                child = self.children.get(values)
+                if child is None:
+                    child = Histogram(self.buckets) if self.kind == "histogram" else Value()
+                    self.children[values] = child
+        return child
+
+    def remove(self, *values):
+        with self._lock:
+            self.children.pop(tuple(str(v) for v in values), None)
+
+    def _labels(self, values, extra=None):
+        pairs = list(zip(self.labelnames, values))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in pairs) + "}"
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.kind)]
+        for values, child in sorted(list(self.children.items()), key=lambda el: el[0]):
+            if self.kind == "histogram":
+                snapshot = child.to_dict()
+                for bound, count in snapshot["buckets"].items():
+                    lines.append("{}_bucket{} {}".format(
+                        self.name, self._labels(values, ("le", bound)), count))
+                lines.append("{}_sum{} {}".format(
+                    self.name, self._labels(values), snapshot["sum"]))
+                lines.append("{}_count{} {}".format(
+                    self.name, self._labels(values), snapshot["count"]))
+            else:
+                lines.append("{}{} {}".format(
+                    self.name, self._labels(values), child.value))
+        return lines
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Registry:
+    """
+    A collection of metric families rendered in the Prometheus text format
+    """
+
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self.families = []
+
+    def _add(self, family):
+        self.families.append(family)
+        return family
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(Family(name, documentation, "counter", labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._add(Family(name, documentation, "gauge", labelnames))
+
+    def histogram(self, name, documentation, buckets, labelnames=()):
+        return self._add(Family(name, documentation, "histogram", labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for family in self.families:
+            lines.extend(family.render())
+        return "\n".join(lines) + "\n"
@@ -17,13 +17,29 @@ from fastapi.logger import logger
 import logging
 
 from starlette.routing import RedirectResponse
+from starlette.responses import JSONResponse, Response, StreamingResponse
 from starlette.routing import Route as starlette_Route
 
 import re
 import urllib
+import time
+import asyncio
 import numpy as np
 from apscheduler.schedulers.background import BackgroundScheduler
 import datetime
+import threading
+import multiprocessing
+import hashlib
+import fnmatch
+import functools
+import yaml
+import fcntl
+import types
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from .metrics import Registry
+from . import tensors
 
 
 # register route
@@ -57,6 +73,99 @@ staging = os.getenv("MLSERVE_STAGING", 'False').lower() in ('true', '1', 't')
 withlinks = os.getenv("MLSERVE_LINKS", 'False').lower() in ('true', '1', 't')
 basepath_re = "^" + basepath.replace("/", "\\/")+"\\/"
 
+# dynamic batching, a batch size of 1 disables the batching
+batch_size = int(os.getenv("MLSERVE_BATCH_SIZE", "1"))
+batch_wait_ms = float(os.getenv("MLSERVE_BATCH_WAIT_MS", "5"))
+
+# prediction workers, "thread" for models releasing the GIL, "process" for pure python models
+executor_type = os.getenv("MLSERVE_EXECUTOR", "thread")
+executor_workers = int(os.getenv("MLSERVE_WORKERS", "4"))
+# per-model limit of running predictions and of requests waiting for a slot
+concurrency = int(os.getenv("MLSERVE_CONCURRENCY", "2"))
+queue_size = int(os.getenv("MLSERVE_QUEUE_SIZE", "32"))
+retry_after = int(os.getenv("MLSERVE_RETRY_AFTER", "1"))
+
+# prediction cache per model, a size of 0 disables the cache
+cache_max_size = int(os.getenv("MLSERVE_CACHE_SIZE", "0"))
+cache_ttl = float(os.getenv("MLSERVE_CACHE_TTL", "300"))
+
+# rows per model.predict call of the /batch routes
+batch_chunk_rows = int(os.getenv("MLSERVE_BATCH_CHUNK", "1024"))
+# largest tensor message or JSON line accepted by the /batch routes
+batch_max_message = int(float(os.getenv("MLSERVE_BATCH_MAX_MESSAGE_MB", "256")) * 2**20)
+
+# page size of the registry listing in update_models
+registry_page_size = int(os.getenv("MLSERVE_REGISTRY_PAGE_SIZE", "100"))
+
+# number of models loaded in parallel by the background loader
+load_workers = int(os.getenv("MLSERVE_LOAD_WORKERS", "4"))
+
+# cold start, models of the priority list and recently used models are loaded first
+startup_workers = int(os.getenv("MLSERVE_STARTUP_WORKERS", "8"))
+startup_delay = int(os.getenv("MLSERVE_STARTUP_DELAY", "10"))
+priority = [el.strip() for el in os.getenv("MLSERVE_PRIORITY", "").split(",") if el.strip()]
+
+# lazy loading, the models are loaded on the first request and evicted
+# in least recently used order when the memory budget is exceeded
+lazy = os.getenv("MLSERVE_LAZY", 'False').lower() in ('true', '1', 't')
+memory_budget = int(os.getenv("MLSERVE_MEMORY_BUDGET_MB", "0")) * (1 << 20)
+
+# local state of the server like the traffic statistics
+state_dir = os.path.expanduser(os.getenv("MLSERVE_STATE_DIR", "~/.mlserve"))
+
+# local cache of the example payloads per run, the artifacts of a run do not change
+artifact_cache = os.getenv("MLSERVE_ARTIFACT_CACHE", 'True').lower() in ('true', '1', 't')
+artifact_cache_dir = os.path.join(state_dir, "artifacts")
+
+# multi worker mode, one coordinator worker polls the registry and publishes the
+# loaded versions in the state dir, the other workers follow these versions
+multi_worker = os.getenv("MLSERVE_MULTI_WORKER", 'False').lower() in ('true', '1', 't')
+sync_interval = int(os.getenv("MLSERVE_SYNC_INTERVAL", "5"))
+# load the models on import, before gunicorn --preload forks the workers, so the
+# workers share the model memory copy-on-write
+preload = os.getenv("MLSERVE_PRELOAD", 'False').lower() in ('true', '1', 't')
+
+# metrics served on /metrics
+latency_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+load_time_buckets = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+batch_size_buckets = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+queue_wait_buckets = [0.0005, 0.001, 0.0025, 0.005,
+                      0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0]
+
+metrics = Registry()
+request_count = metrics.counter(
+    "mlserve_requests_total", "Requests per model and status code", ["model", "status"])
+request_latency = metrics.histogram(
+    "mlserve_request_seconds", "Request latency per model", latency_buckets, ["model"])
+phase_latency = metrics.histogram(
+    "mlserve_request_phase_seconds", "Latency of the parse, predict and serialize phases",
+    latency_buckets, ["model", "phase"])
+requests_in_flight = metrics.gauge(
+    "mlserve_requests_in_flight", "Requests currently served per model", ["model"])
+model_load_time = metrics.histogram(
+    "mlserve_model_load_seconds", "Load time of the models in update_models",
+    load_time_buckets, ["model"])
+batch_size_metric = metrics.histogram(
+    "mlserve_batch_size", "Requests per dynamic batch", batch_size_buckets, ["model"])
+queue_wait_metric = metrics.histogram(
+    "mlserve_batch_queue_wait_seconds", "Wait time of a request for its batch",
+    queue_wait_buckets, ["model"])
+cache_hits = metrics.counter(
+    "mlserve_model_cache_hits_total", "Requests served by a cached lazy model")
+cache_misses = metrics.counter(
+    "mlserve_model_cache_misses_total", "Requests which loaded a lazy model")
+cache_evictions = metrics.counter(
+    "mlserve_model_cache_evictions_total", "Models evicted from the model cache")
+cache_load_time = metrics.histogram(
+    "mlserve_model_cache_load_seconds", "Load time of lazy models", load_time_buckets)
+cache_size = metrics.gauge(
+    "mlserve_model_cache_bytes", "Estimated memory of the cached lazy models")
+prediction_hits = metrics.counter(
+    "mlserve_prediction_cache_hits_total", "Predictions served from the cache", ["model"])
+prediction_misses = metrics.counter(
+    "mlserve_prediction_cache_misses_total", "Predictions missing in the cache", ["model"])
+
 tags_metadata = [
     {
         "name": "Metadata",
@@ -70,17 +179,116 @@ tags_metadata = [
 
 app = FastAPI(root_path=basepath, redoc_url=None, tags_metadata=tags_metadata)
 security = HTTPBearer()
-valid_tokens = [val for kev, val in config["MLflowModelServerTokens"].items()]
 
 
-def check_token(token):
-    if token.credentials in valid_tokens:
+class RateLimit:
+    """
+    Token bucket allowing rate requests per second with bursts of the same size
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def acquire(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
         return True
-    raise HTTPException(
-        status_code=401,
-        detail="Incorrect username or password",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+
+
+class TokenInfo:
+
+    def __init__(self, name, scopes=None, rate_limit=None):
+        self.name = name
+        self.scopes = scopes
+        self.rate_limit = RateLimit(rate_limit) if rate_limit else None
+
+    def allows(self, model):
+        return self.scopes is None or any(fnmatch.fnmatchcase(model, s) for s in self.scopes)
+
+
+@functools.lru_cache(maxsize=1024)
+def hash_token(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def load_tokens(cfg):
+    """
+    Build the token table keyed by the SHA-256 hash of each token
+
+    [MLflowModelServerTokens] maps a client name to its token, either in plain
+    text or as "sha256:<hex digest>". The optional sections
+    [MLflowModelServerScopes] (comma separated model name patterns) and
+    [MLflowModelServerRateLimits] (requests per second) are keyed by the client name.
+    """
+    scopes = cfg["MLflowModelServerScopes"] if cfg.has_section("MLflowModelServerScopes") else {}
+    limits = cfg["MLflowModelServerRateLimits"] if cfg.has_section("MLflowModelServerRateLimits") else {}
+
+    table = {}
+    for name, val in cfg["MLflowModelServerTokens"].items():
+        digest = val[len("sha256:"):].lower() if val.startswith("sha256:") else hash_token(val)
+        table[digest] = TokenInfo(
+            name,
+            [el.strip() for el in scopes[name].split(",") if el.strip()] if name in scopes else None,
+            float(limits[name]) if name in limits else None)
+    return table
+
+
+token_table = load_tokens(config)
+token_config_mtime = os.path.getmtime('/defaults.cfg') if os.path.exists('/defaults.cfg') else None
+token_reload = int(os.getenv("MLSERVE_TOKEN_RELOAD", "30"))
+
+
+def reload_tokens():
+    """
+    Reload the token table if /defaults.cfg changed
+    """
+    global token_table, token_config_mtime
+
+    try:
+        mtime = os.path.getmtime('/defaults.cfg')
+    except OSError:
+        return
+    if mtime == token_config_mtime:
+        return
+
+    cfg = configparser.ConfigParser()
+    cfg.read('/defaults.cfg')
+    try:
+        token_table = load_tokens(cfg)
+    except Exception:
+        logger.exception("Reloading the tokens failed, keeping the old tokens")
+        return
+    token_config_mtime = mtime
+    logger.info(f"Reloaded {len(token_table)} tokens")
+
+
+def check_token(token, model=None):
+    info = token_table.get(hash_token(token.credentials))
+    if info is None:
+        raise HTTPException(
+            status_code=401,
+            detail="Incorrect username or password",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    if model is not None and not info.allows(model):
+        raise HTTPException(
+            status_code=403,
+            detail=f"Token is not allowed to use model {model}",
+        )
+    if info.rate_limit is not None and not info.rate_limit.acquire():
+        raise HTTPException(
+            status_code=429,
+            detail="Rate limit exceeded",
+            headers={"Retry-After": str(max(1, int(1 / info.rate_limit.rate)))},
+        )
+    return True
 
 
 gunicorn_logger = logging.getLogger('gunicorn.error')
@@ -88,20 +296,93 @@ logger.handlers = gunicorn_logger.handlers
 logger.setLevel(gunicorn_logger.level)
 
 
-def custom_openapi():
-    if app.openapi_schema:
-        return app.openapi_schema
-    openapi_schema = get_openapi(
+openapi_lock = threading.Lock()
+openapi_document = None
+
+
+def openapi_fragment(routes):
+    """
+    Generate the OpenAPI schema of a list of routes
+    """
+    return get_openapi(
         title="MLflow Models",
         version="1.0.0",
         description="All local MLflow models",
-        routes=app.routes,
+        routes=routes,
     )
-    app.openapi_schema = openapi_schema
-    return app.openapi_schema
+
+
+def merge_openapi(schema, old, new):
+    """
+    Replace the paths and component schemas of the fragment old by the ones of new
+    """
+    paths = schema.setdefault("paths", {})
+    schemas = schema.setdefault("components", {}).setdefault("schemas", {})
+    new_schemas = new.get("components", {}).get("schemas", {})
+    if old is not None:
+        for path in old.get("paths", {}):
+            paths.pop(path, None)
+        for key in old.get("components", {}).get("schemas", {}):
+            if key not in new_schemas:
+                schemas.pop(key, None)
+    paths.update(new.get("paths", {}))
+    schemas.update(new_schemas)
+
+
+def update_openapi(old, new):
+    """
+    Merge the fragment of a new handler into the cached schema, called on install
+    """
+    global openapi_document
+    with openapi_lock:
+        if app.openapi_schema is not None:
+            merge_openapi(app.openapi_schema, old, new)
+        openapi_document = None
+
+
+def custom_openapi():
+    """
+    Build the schema once from the static routes and the fragments of the model
+    handlers, later model versions are merged in by update_openapi
+    """
+    with openapi_lock:
+        if app.openapi_schema:
+            return app.openapi_schema
+        openapi_schema = openapi_fragment(
+            [r for r in app.routes if not isinstance(r, TensorRoute)])
+        for handler in list(model_dict.values()):
+            merge_openapi(openapi_schema, None, handler.openapi)
+        app.openapi_schema = openapi_schema
+        return app.openapi_schema
+
+
+def get_openapi_document():
+    """
+    Serialized schema and its ETag, both are cached until the schema changes
+    """
+    global openapi_document
+    schema = app.openapi()
+    with openapi_lock:
+        if openapi_document is None:
+            content = json.dumps(schema).encode("utf-8")
+            etag = '"{}"'.format(hashlib.sha1(content).hexdigest())
+            openapi_document = (content, etag)
+        return openapi_document
+
+
+async def openapi_json(request):
+    content, etag = get_openapi_document()
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content, media_type="application/json",
+                    headers={"ETag": etag, "Cache-Control": "no-cache"})
 
 
 app.openapi = custom_openapi
+app.router.routes = [
+    starlette_Route(app.openapi_url, openapi_json, include_in_schema=False)
+    if getattr(r, "path", None) == app.openapi_url else r
+    for r in app.router.routes]
 
 for r in app.routes:
     if not isinstance(r, fastapi.routing.APIRoute):
@@ -116,8 +397,302 @@ app.routes.append(starlette_Route(basepath, redirect_to_docs))
 app.routes.append(starlette_Route(basepath+"/", redirect_to_docs))
 
 
+@app.get(basepath+"/ready", tags=["Metadata"])
+async def ready():
+    """
+    Load state of all models, returns 503 until every model is served. Reloads
+    of served models do not count, the old version keeps serving meanwhile
+    """
+    states = {name: model_state(name) for name in set(model_states) | set(model_dict)}
+    is_ready = registry_listed and not any(
+        state["state"] in ("pending", "loading", "failed") for state in states.values())
+    return JSONResponse(status_code=200 if is_ready else 503,
+                        content={"ready": is_ready, "models": states})
+
+
+@app.post(basepath+"/refresh/{model}", tags=["Metadata"])
+async def refresh(model: str, force: bool = False, token: str = Depends(security)):
+    """
+    Check a single model in the registry now and load its selected version if it
+    changed, force reloads the current version. In multi worker mode a follower
+    forwards the refresh to the coordinator, the followers pick the new version up
+    from the coordinator within MLSERVE_SYNC_INTERVAL seconds
+    """
+    # scopes match the quoted name the model is served under
+    model = urllib.parse.unquote_plus(model)
+    check_token(token, urllib.parse.quote_plus(model))
+
+    loop = asyncio.get_event_loop()
+    try:
+        m = await loop.run_in_executor(
+            None, client.get_registered_model, model)
+    except Exception as ex:
+        raise HTTPException(status_code=404, detail=str(ex))
+
+    name = urllib.parse.quote_plus(m.name)
+    if not is_coordinator():
+        forward_refresh(name, force)
+        return {"model": name, "reload": None, "forwarded": True, "state": model_state(name)}
+
+    el = await loop.run_in_executor(None, check_model, m, force)
+    if el is not None:
+        logger.info(f"Refresh model {el[0]}")
+        loader.submit(load_model, *el)
+
+    return {"model": name, "reload": el is not None, "state": model_state(name)}
+
+
+@app.get(basepath+"/metrics", tags=["Metadata"])
+async def metrics_endpoint():
+    """
+    Request, latency, batching, cache and load metrics in the Prometheus text format
+    """
+    return Response(content=metrics.render(), media_type=metrics.content_type)
+
+
+@app.get(basepath+"/model_cache", tags=["Metadata"])
+async def model_cache_stats():
+    """
+    Loaded models, hits, misses, load time and evictions of the lazy model cache
+    """
+    return model_cache.to_dict()
+
+
+@app.get(basepath+"/batching", tags=["Metadata"])
+async def batching():
+    """
+    Batch size and queue wait histograms of the models with dynamic batching
+    """
+    return {name: handler.batcher.to_dict()
+            for name, handler in list(model_dict.items()) if handler.batcher}
+
+
 model_dict = {}
 
+# last update timestamp of each registered model with a loaded version
+registry_timestamps = {}
+
+# load state of each model for the readiness check
+model_states = {}
+registry_listed = False
+
+
+def model_state(name):
+    """
+    Load state of a model, the load of a new version of a served model is
+    reported as loading_state and loading_version next to the serving_version
+    """
+    state = dict(model_states.get(name, {}))
+    handler = model_dict.get(name)
+    if handler is None or (state.get("state") == "ready" and state.get("version") == handler.version):
+        return state
+
+    output = {"state": "ready", "serving_version": handler.version}
+    if state:
+        output.update(loading_state=state.pop("state"), loading_version=state.pop("version"), **state)
+    return output
+
+# last request time of each model, persisted to order the startup
+traffic = {}
+traffic_file = os.path.join(state_dir, "traffic.json")
+
+
+def load_traffic():
+    try:
+        with open(traffic_file, "r") as f:
+            traffic.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+
+
+def save_traffic():
+    if not traffic:
+        return
+    os.makedirs(state_dir, exist_ok=True)
+    with open(traffic_file + ".tmp", "w") as f:
+        json.dump(traffic, f)
+    os.replace(traffic_file + ".tmp", traffic_file)
+
+executors = {}
+executors_lock = threading.Lock()
+
+
+def get_executor(kind):
+    """
+    Return the shared prediction pool of the given kind, created on first use
+    """
+    with executors_lock:
+        if kind not in executors:
+            if kind == "process":
+                # fork to reuse the imported module without its startup side effects
+                executors[kind] = ProcessPoolExecutor(
+                    executor_workers, mp_context=multiprocessing.get_context("fork"))
+            else:
+                executors[kind] = ThreadPoolExecutor(
+                    executor_workers, thread_name_prefix="predict")
+        return executors[kind]
+
+
+def cached_json(run_id, key, compute):
+    """
+    Return the JSON value of a run artifact or a value derived from it, the
+    value is computed once and stored on disk keyed by run_id and key
+    """
+    if not artifact_cache:
+        return compute()
+
+    digest = hashlib.sha1(f"{run_id}/{key}".encode("utf-8")).hexdigest()
+    path = os.path.join(artifact_cache_dir, digest + ".json")
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    value = compute()
+    try:
+        os.makedirs(artifact_cache_dir, exist_ok=True)
+        with open(f"{path}.{os.getpid()}.tmp", "w") as f:
+            json.dump(value, f)
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+    except (OSError, TypeError, ValueError):
+        logger.warning(f"Caching {key} of run {run_id} failed")
+    return value
+
+
+def load_json_artifact(run_id, artifact_path):
+    res = load_artifact(run_id, artifact_path)
+    res.raise_for_status()
+    return res.json()
+
+
+def load_metadata(model_version):
+    """
+    Read the MLmodel file of a model version without loading the model
+    """
+    path = os.path.join(model_version.source, "MLmodel")
+    if os.path.isfile(path):
+        return mlflow.models.Model.load(path)
+
+    # a run can log several models, the artifact path tells them apart
+    artifact_path = os.path.join(model_version.source.split("/artifacts/", 1)[1], "MLmodel")
+
+    def fetch():
+        res = load_artifact(model_version.run_id, artifact_path)
+        res.raise_for_status()
+        return yaml.safe_load(res.text)
+
+    return mlflow.models.Model.from_dict(
+        cached_json(model_version.run_id, artifact_path, fetch))
+
+
+def model_size(source):
+    """
+    Estimate the memory of a model by the size of its local artifacts
+    """
+    size = 0
+    for root, _, files in os.walk(source):
+        for f in files:
+            try:
+                size += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return size
+
+
+class ModelCache:
+    """
+    LRU cache of loaded pyfunc models bounded by an estimated memory budget
+
+    A budget of 0 disables the eviction. The most recently used model is never
+    evicted, even if it exceeds the budget on its own.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.models = OrderedDict()
+        self.key_locks = {}
+        self.lock = threading.Lock()
+        self.hits = cache_hits.labels()
+        self.misses = cache_misses.labels()
+        self.evictions = cache_evictions.labels()
+        self.load_time = cache_load_time.labels()
+        self.bytes = cache_size.labels()
+
+    def get(self, key, load):
+        """
+        Return the cached model or load it, concurrent misses load only once
+        """
+        with self.lock:
+            if key in self.models:
+                return self._hit(key)
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self.lock:
+                if key in self.models:
+                    return self._hit(key)
+                self.misses.inc()
+
+            start = time.monotonic()
+            model, size = load()
+            self.load_time.observe(time.monotonic() - start)
+
+            with self.lock:
+                self.models[key] = (model, size)
+                self.key_locks.pop(key, None)
+                self._evict()
+                self.bytes.set(self.size())
+            return model
+
+    def discard(self, key):
+        with self.lock:
+            self.models.pop(key, None)
+            self.bytes.set(self.size())
+
+    def size(self):
+        return sum(size for _, size in self.models.values())
+
+    def _hit(self, key):
+        self.hits.inc()
+        self.models.move_to_end(key)
+        return self.models[key][0]
+
+    def _evict(self):
+        while self.budget and len(self.models) > 1 and self.size() > self.budget:
+            key, _ = self.models.popitem(last=False)
+            self.evictions.inc()
+            logger.info(f"Evict model {key[0]} from the model cache")
+
+    def to_dict(self):
+        with self.lock:
+            loaded = {key[0]: size for key, (_, size) in self.models.items()}
+        return {
+            "budget_bytes": self.budget,
+            "size_bytes": sum(loaded.values()),
+            "loaded": loaded,
+            "hits": self.hits.value,
+            "misses": self.misses.value,
+            "evictions": self.evictions.value,
+            "load_time": self.load_time.to_dict(),
+        }
+
+
+model_cache = ModelCache(memory_budget)
+
+
+# models loaded inside the worker processes of the process pool
+process_models = {}
+
+
+def process_predict(name, source, np_input):
+    """
+    Predict in a worker process, the model is loaded once per process and version
+    """
+    if name not in process_models or process_models[name][0] != source:
+        process_models[name] = (source, mlflow.pyfunc.load_model(source))
+    return process_models[name][1].predict(np_input)
+
 
 def get_version(m):
     prod_models = [
@@ -132,6 +707,314 @@ def get_version(m):
     return m.latest_versions[0]
 
 
+def get_setting(m, key, default):
+    """
+    Read a per-model setting from the registered model tag "mlserve.<key>",
+    the server wide default is given by the caller
+    """
+    tags = getattr(m, "tags", None) or {}
+    if "mlserve." + key in tags:
+        try:
+            return type(default)(tags["mlserve." + key])
+        except ValueError:
+            logger.warning(f"Invalid tag mlserve.{key} on model {m.name}")
+    return default
+
+
+def get_settings(m):
+    return {
+        "batch_size": get_setting(m, "batch_size", batch_size),
+        "batch_wait_ms": get_setting(m, "batch_wait_ms", batch_wait_ms),
+        "executor": get_setting(m, "executor", executor_type),
+        "concurrency": get_setting(m, "concurrency", concurrency),
+        "queue_size": get_setting(m, "queue_size", queue_size),
+        "cache_size": get_setting(m, "cache_size", cache_max_size),
+        "cache_ttl": get_setting(m, "cache_ttl", cache_ttl),
+    }
+
+
+class PredictionCache:
+    """
+    Bounded LRU cache of model outputs with a time to live
+
+    The key is the hash of the model run and of the canonical input tensors,
+    i.e. the sorted names with dtype, shape and data of each tensor. The cache
+    is only used from the event loop and needs no locking.
+    """
+
+    def __init__(self, name, run_id, max_size, ttl):
+        self.run_id = run_id
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = prediction_hits.labels(name)
+        self.misses = prediction_misses.labels(name)
+
+    def key(self, np_input):
+        h = hashlib.blake2b(self.run_id.encode("utf-8"), digest_size=16)
+        for name in sorted(np_input):
+            arr = np.asarray(np_input[name])
+            h.update(name.encode("utf-8"))
+            h.update(arr.dtype.str.encode("utf-8"))
+            h.update(str(arr.shape).encode("utf-8"))
+            if arr.dtype.hasobject:
+                h.update(json.dumps(arr.tolist()).encode("utf-8"))
+            else:
+                h.update(np.ascontiguousarray(arr).data)
+        return h.digest()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses.inc()
+            return None
+        self.entries.move_to_end(key)
+        self.hits.inc()
+        return entry[1]
+
+    def put(self, key, output):
+        self.entries[key] = (time.monotonic() + self.ttl, output)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+def input_signature(np_input):
+    """
+    Key of inputs which can be stacked along the first axis, None if the
+    input can not be stacked
+    """
+    if not isinstance(np_input, dict) or len(np_input) == 0:
+        return None
+    values = list(np_input.values())
+    if any(not isinstance(v, np.ndarray) or v.ndim == 0 for v in values):
+        return None
+    if len({len(v) for v in values}) != 1:
+        return None
+    return tuple(sorted((k, v.dtype.str, v.shape[1:]) for k, v in np_input.items()))
+
+
+def input_rows(np_input):
+    return len(next(iter(np_input.values())))
+
+
+def stack_inputs(inputs):
+    return {key: np.concatenate([np_input[key] for np_input in inputs])
+            for key in inputs[0]}
+
+
+def split_output(output, rows):
+    """
+    Split a stacked output back into parts of the given row counts, returns
+    None if the output is not row aligned with the input
+    """
+    offsets = np.cumsum(rows)[:-1]
+    total = sum(rows)
+    if isinstance(output, dict):
+        values = list(output.values())
+        if any(not isinstance(v, np.ndarray) or v.ndim == 0 or len(v) != total for v in values):
+            return None
+        parts = {k: np.split(v, offsets) for k, v in output.items()}
+        return [{k: parts[k][i] for k in output} for i in range(len(rows))]
+    if isinstance(output, np.ndarray) and output.ndim > 0 and len(output) == total:
+        return np.split(output, offsets)
+    return None
+
+
+class MicroBatcher:
+    """
+    Coalesce concurrent predictions of a model into a single predict call
+
+    Requests are collected until max_batch_size is reached or the oldest
+    request waited max_wait seconds. The tensors of each request are stacked
+    along the first axis and the outputs are split back per caller. Inputs
+    which can not be stacked, e.g. if the first axis of the schema is not the
+    batch axis, are predicted one by one, as are the inputs of a failed batch.
+    """
+
+    def __init__(self, name, predict, max_batch_size, max_wait, batched=True):
+        self.predict = predict
+        self.batched = batched
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batch_size = batch_size_metric.labels(name)
+        self.queue_wait = queue_wait_metric.labels(name)
+        self._queue = None
+        self._task = None
+        self._loop = None
+        self._closed = False
+
+    async def submit(self, np_input):
+        """
+        Queue the input for the next batch and wait for its output
+        """
+        if self._closed or (self._task is not None and self._task.done()):
+            # the handler was replaced while the request was read, nobody
+            # collects the queue anymore
+            return await self.predict(np_input)
+
+        if self._queue is None:
+            # the handler is created in the scheduler thread, so the asyncio
+            # objects are bound to the serving loop on first use
+            self._loop = asyncio.get_event_loop()
+            self._queue = asyncio.Queue()
+            self._task = self._loop.create_task(self._run())
+
+        future = self._loop.create_future()
+        await self._queue.put((np_input, future, time.monotonic()))
+        return await future
+
+    def close(self):
+        """
+        Stop the batching task, can be called from any thread
+        """
+        self._closed = True
+        if self._task is not None:
+            self._loop.call_soon_threadsafe(self._task.cancel)
+
+    def to_dict(self):
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "batch_size": self.batch_size.to_dict(),
+            "queue_wait": self.queue_wait.to_dict(),
+        }
+
+    async def _run(self):
+        items = []
+        try:
+            while True:
+                items = [await self._queue.get()]
+                deadline = self._loop.time() + self.max_wait
+
+                while len(items) < self.max_batch_size:
+                    timeout = deadline - self._loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        items.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+                self._dispatch(items)
+                items = []
+        except asyncio.CancelledError:
+            # the handler was replaced, serve the waiting requests anyway
+            while not self._queue.empty():
+                items.append(self._queue.get_nowait())
+            self._dispatch(items)
+            raise
+
+    def _dispatch(self, items):
+        now = time.monotonic()
+        for _, _, queued in items:
+            self.queue_wait.observe(now - queued)
+
+        # group the requests by stackable signature
+        groups = {}
+        for item in items:
+            key = input_signature(item[0]) if self.batched else None
+            if key is None:
+                key = id(item)
+            groups.setdefault(key, []).append(item)
+
+        # predict the groups in the background to collect the next batch
+        for group in groups.values():
+            self._loop.create_task(self._predict_group(group))
+
+    async def _predict_single(self, np_input, future):
+        self.batch_size.observe(1)
+        try:
+            output = await self.predict(np_input)
+        except Exception as ex:
+            if not future.done():
+                future.set_exception(ex)
+        else:
+            if not future.done():
+                future.set_result(output)
+
+    async def _predict_group(self, group):
+        if len(group) == 1:
+            await self._predict_single(group[0][0], group[0][1])
+            return
+
+        inputs = [np_input for np_input, _, _ in group]
+        rows = [input_rows(np_input) for np_input in inputs]
+
+        try:
+            batch = stack_inputs(inputs)
+            self.batch_size.observe(len(group))
+            outputs = split_output(await self.predict(batch), rows)
+        except Exception:
+            # the model does not accept the stacked input, the errors of the
+            # single calls go to their callers
+            outputs = None
+
+        if outputs is None:
+            # the model output is not row aligned, fall back to single calls
+            await asyncio.gather(*[self._predict_single(np_input, future)
+                                   for np_input, future, _ in group])
+            return
+
+        for (_, future, _), output in zip(group, outputs):
+            if not future.done():
+                future.set_result(output)
+
+
+class BodyStreamingResponse(StreamingResponse):
+    """
+    Streaming response which reads the request body while streaming, it does not
+    listen for a disconnect as this would consume the messages of the body
+    """
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start",
+                    "status": self.status_code,
+                    "headers": self.raw_headers})
+        async for chunk in self.body_iterator:
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+class TensorRoute(fastapi.routing.APIRoute):
+    """
+    Model route which passes the requests to the serve function of its handler,
+    the JSON schema of the endpoint documents the API but the handler decodes the
+    inputs with its precompiled decoder instead of the per-element pydantic validation
+    """
+
+    serve = None
+
+    def get_route_handler(self):
+        json_handler = super().get_route_handler()
+
+        async def route_handler(request: Request):
+            serve = self.serve
+            if serve is None:
+                return await json_handler(request)
+
+            start = time.monotonic()
+            in_flight = requests_in_flight.labels(self.name)
+            in_flight.inc()
+            status = 500
+            try:
+                response = await serve(request)
+                status = response.status_code
+                return response
+            except HTTPException as ex:
+                status = ex.status_code
+                raise
+            finally:
+                in_flight.dec()
+                request_count.labels(self.name, status).inc()
+                request_latency.labels(self.name).observe(time.monotonic() - start)
+
+        return route_handler
+
+
 class PyFuncHandler:
 
     dtype_sample = {
@@ -143,35 +1026,55 @@ class PyFuncHandler:
         "str": "A",
     }
 
-    def __init__(self, name, model_version, description):
+    def __init__(self, name, model_version, description, settings=None):
+        settings = settings or {}
         try:
-            model = mlflow.pyfunc.load_model(model_version.source)
-            input_schema = model.metadata.get_input_schema()
-            output_schema = model.metadata.get_output_schema()
+            if lazy:
+                # register the route from the metadata, the model is loaded on request
+                model = None
+                metadata = load_metadata(model_version)
+            else:
+                model = mlflow.pyfunc.load_model(model_version.source)
+                metadata = model.metadata
+            input_schema = metadata.get_input_schema()
+            output_schema = metadata.get_output_schema()
         except:
             model = None
+            metadata = None
             input_schema = None
             output_schema = None
 
+        # the examples are cached per run, a reload of the same run skips the
+        # artifact request and the example prediction
         try:
-            res = load_artifact(model_version.run_id, os.path.join(model.metadata.artifact_path,
-                                model.metadata.saved_input_example_info['artifact_path']
-                                                                   ))
-            input_example_data = res.json()['inputs']
+            input_example_path = os.path.join(metadata.artifact_path,
+                                              metadata.saved_input_example_info['artifact_path'])
+            input_example_data = cached_json(
+                model_version.run_id, input_example_path,
+                lambda: load_json_artifact(model_version.run_id, input_example_path))['inputs']
         except:
+            input_example_path = None
             input_example_data = {}
 
+        input_defaults = {el["name"]:
+                          input_example_data[el["name"]]
+                          if el["name"] in input_example_data else
+                          self.get_example_el(el) for el in input_schema.to_dict()}
         input_schema_class = type(name+"-input",
                                   (BaseModel, ),
-                                  {el["name"]:
-                                   input_example_data[el["name"]]
-                                   if el["name"] in input_example_data else
-                                   self.get_example_el(el) for el in input_schema.to_dict()})
+                                  dict(input_defaults))
+
+        # dtypes, shapes and defaults of the inputs are computed once per version
+        decoder = tensors.InputDecoder(input_schema.to_dict(), input_defaults)
+
+        def predict_example():
+            output = model.predict(decoder.decode(input_example_data))
+            return {k: v.tolist() for k, v in output.items()}
 
         try:
-            np_input = self.numpy_input(input_example_data, input_schema)
-            output_example_data = model.predict(np_input)
-            output_example_data = {k:v.tolist() for k,v in output_example_data.items()}
+            output_example_data = cached_json(
+                model_version.run_id, f"output-example/{model_version.source}/{input_example_path}",
+                predict_example)
         except:
             output_example_data = {}
 
@@ -188,9 +1091,33 @@ class PyFuncHandler:
         self.model = model
         self.input_schema = input_schema
         self.output_schema = output_schema
+        self.decoder = decoder
         self.input_schema_class = input_schema_class()
         self.output_schema_class = output_schema_class()
 
+        self.name = name
+        self.executor = settings.get("executor", executor_type)
+        self.concurrency = max(1, settings.get("concurrency", concurrency))
+        self.queue_size = settings.get("queue_size", queue_size)
+        self.pending = 0
+        self._semaphore = None
+
+        self.batcher = None
+        if settings.get("batch_size", 1) > 1:
+            self.batcher = MicroBatcher(name, self._predict,
+                                        settings["batch_size"],
+                                        settings.get("batch_wait_ms", batch_wait_ms) / 1000,
+                                        decoder.batched)
+
+        self.cache = None
+        if settings.get("cache_size", 0) > 0:
+            self.cache = PredictionCache(name, self.run_id,
+                                         settings["cache_size"],
+                                         settings.get("cache_ttl", cache_ttl))
+
+        self.phase = {phase: phase_latency.labels(name, phase)
+                      for phase in ("parse", "predict", "serialize")}
+
         long_description = f"""{description}
 
 <b>Input Schema:</b> {self.get_schema_string(input_schema)} <br/>
@@ -199,26 +1126,274 @@ class PyFuncHandler:
 <b>Run: </b> {self.get_experiment_link(model_version)}
         """
 
-        @app.post(basepath+'/'+name, description=long_description, name=name, tags=["Models"], response_model=output_schema_class)
+        # the route is installed by install_handler to replace the old version in place
+        router = fastapi.APIRouter(dependency_overrides_provider=app,
+                                   route_class=TensorRoute)
+
+        @router.post(basepath+'/'+name, description=long_description, name=name, tags=["Models"], response_model=output_schema_class)
         async def func(data: input_schema_class, token: str = Depends(security)):
-            check_token(token)
+            # documents the request and response schema only, TensorRoute
+            # dispatches the JSON and binary requests to self.serve
+            pass
+
+        @router.post(basepath+'/'+name+'/batch', name=name+"/batch", tags=["Models"], description=f"""{description}
+
+Batch prediction of <b>{name}</b>. The body is a stream of JSON input objects, one per
+line (application/x-ndjson), or a stream of binary tensor messages
+({tensors.content_type}). The inputs are predicted in chunks of up to {batch_chunk_rows} rows
+and the outputs are streamed back in input order, as JSON lines or as tensor messages
+depending on the Accept header.
+        """)
+        async def batch(request: Request, token: str = Depends(security)):
+            return await self.serve_batch(request)
+
+        self.route, self.batch_route = router.routes[-2:]
+        self.route.serve = self.serve
+        self.batch_route.serve = self.serve_batch
+        self.routes = [self.route, self.batch_route]
+        self.openapi = openapi_fragment(self.routes)
+
+    async def serve(self, request):
+        """
+        Serve a request as JSON or in the binary tensor format, the Content-Type
+        selects the input and the Accept header the output format
+        """
+        check_token(await security(request), self.name)
+        traffic[self.name] = time.time()
 
-            try:
-                np_input = self.numpy_input(data.__dict__, input_schema)
-            except Exception as ex:
-                raise self.get_error_message("Parse input error", ex)
+        start = time.monotonic()
+        try:
+            if tensors.is_tensor_type(request.headers.get("content-type")):
+                np_input = self.decoder.cast(tensors.decode(await request.body()))
+            else:
+                np_input = self.decoder.decode(json.loads(await request.body()))
+        except Exception as ex:
+            raise self.get_error_message("Parse input error", ex)
+        self.phase["parse"].observe(time.monotonic() - start)
+
+        output = await self.infer(np_input)
+
+        start = time.monotonic()
+        try:
+            if tensors.is_tensor_type(request.headers.get("accept")):
+                response = Response(content=tensors.encode(output),
+                                    media_type=tensors.content_type)
+            else:
+                response = JSONResponse(content=self.parse_output(output))
+        except Exception as ex:
+            raise self.get_error_message("Parse output error", ex)
+        self.phase["serialize"].observe(time.monotonic() - start)
+
+        return response
+
+    async def serve_batch(self, request):
+        """
+        Predict a streamed body in chunks and stream the outputs back
+        """
+        check_token(await security(request), self.name)
+        traffic[self.name] = time.time()
+
+        binary_output = tensors.is_tensor_type(request.headers.get("accept"))
 
+        async def outputs():
             try:
-                output = model.predict(np_input)
+                async for chunk in self.batch_chunks(request):
+                    for output in await self.predict_chunk(chunk):
+                        if binary_output:
+                            yield tensors.encode(output)
+                        else:
+                            yield json.dumps(self.parse_output(output)).encode("utf-8") + b"\n"
+            except HTTPException as ex:
+                # the status is already sent, report the error in the stream
+                logger.warning(f"Batch prediction of {self.name} failed: {ex.status_code} {ex.detail}")
+                yield self.batch_error(ex.detail, binary_output)
             except Exception as ex:
-                raise self.get_error_message("Model prediction error", ex)
+                logger.exception(f"Batch prediction of {self.name} failed")
+                yield self.batch_error(str(ex), binary_output)
+
+        return BodyStreamingResponse(
+            outputs(),
+            media_type=tensors.content_type if binary_output else "application/x-ndjson")
+
+    def batch_error(self, detail, binary_output):
+        """
+        The error marker ending a batch stream, a JSON line or an error tensor message
+        """
+        if binary_output:
+            return tensors.encode_error(detail)
+        return json.dumps({"error": detail}).encode("utf-8") + b"\n"
 
+    async def batch_inputs(self, request):
+        """
+        Decode the inputs of a streamed body one by one, large tensor messages
+        are sliced into parts of at most the chunk size. At most one message or
+        line of up to batch_max_message bytes is buffered.
+        """
+        binary_input = tensors.is_tensor_type(request.headers.get("content-type"))
+        buffer = bytearray()
+        # size of the tensor message at the start of the buffer, None while the header is incomplete
+        size = None
+        # the JSON buffer up to scanned holds no newline
+        scanned = 0
+        async for data in request.stream():
+            buffer += data
+            if binary_input:
+                while True:
+                    if size is None:
+                        size = tensors.message_size(buffer)
+                    if (size or len(buffer)) > batch_max_message:
+                        raise ValueError(f"Tensor message larger than {batch_max_message} bytes")
+                    if size is None or len(buffer) < size:
+                        break
+
+                    message = buffer[:size]
+                    del buffer[:size]
+                    size = None
+
+                    np_input = self.decoder.cast(tensors.decode(memoryview(message).toreadonly()))
+                    if self.signature(np_input) is None:
+                        yield np_input
+                        continue
+                    for offset in range(0, input_rows(np_input), batch_chunk_rows):
+                        yield {k: v[offset:offset + batch_chunk_rows] for k, v in np_input.items()}
+            else:
+                while True:
+                    end = buffer.find(b"\n", scanned)
+                    if end < 0:
+                        scanned = len(buffer)
+                        if scanned > batch_max_message:
+                            raise ValueError(f"Input line longer than {batch_max_message} bytes")
+                        break
+
+                    line = bytes(buffer[:end])
+                    del buffer[:end + 1]
+                    scanned = 0
+                    if line.strip():
+                        yield self.decoder.decode(json.loads(line))
+
+        if buffer.strip():
+            if binary_input:
+                raise ValueError("Incomplete tensor message at the end of the body")
+            yield self.decoder.decode(json.loads(bytes(buffer)))
+
+    async def batch_chunks(self, request):
+        """
+        Group the streamed inputs into chunks of up to batch_chunk_rows rows
+        """
+        chunk = []
+        rows = 0
+        async for np_input in self.batch_inputs(request):
+            if self.signature(np_input) is None:
+                if chunk:
+                    yield chunk
+                yield [np_input]
+                chunk, rows = [], 0
+                continue
+            if chunk and rows + input_rows(np_input) > batch_chunk_rows:
+                yield chunk
+                chunk, rows = [], 0
+            chunk.append(np_input)
+            rows += input_rows(np_input)
+        if chunk:
+            yield chunk
+
+    async def predict_chunk(self, chunk):
+        """
+        Predict a chunk of inputs with a single call if they can be stacked
+        """
+        keys = {self.signature(np_input) for np_input in chunk}
+        if len(chunk) > 1 and None not in keys and len(keys) == 1:
             try:
-                output = self.parse_output(output)
-            except Exception as ex:
-                raise self.get_error_message("Parse output error", ex)
+                outputs = split_output(await self.infer(stack_inputs(chunk)),
+                                       [input_rows(np_input) for np_input in chunk])
+            except HTTPException as ex:
+                # a busy model is not retried, prediction errors are by input
+                if ex.status_code == 503:
+                    raise
+                outputs = None
+            if outputs is not None:
+                return outputs
+        return [await self.infer(np_input) for np_input in chunk]
+
+    def signature(self, np_input):
+        """
+        Key of inputs which can be stacked, None if they can not or the first
+        axis of the model input is not the batch axis
+        """
+        return input_signature(np_input) if self.decoder.batched else None
 
-            return output
+    async def infer(self, np_input):
+        start = time.monotonic()
+        try:
+            output = await self.predict(np_input)
+        except HTTPException:
+            raise
+        except Exception as ex:
+            raise self.get_error_message("Model prediction error", ex)
+        self.phase["predict"].observe(time.monotonic() - start)
+        return output
+
+    async def predict(self, np_input):
+        if self.cache is None:
+            return await self._admit(np_input)
+
+        key = self.cache.key(np_input)
+        output = self.cache.get(key)
+        if output is None:
+            output = await self._admit(np_input)
+            self.cache.put(key, output)
+        return output
+
+    async def _admit(self, np_input):
+        # admission control, reject instead of queuing without bounds
+        if self.pending >= self.concurrency + self.queue_size:
+            raise HTTPException(
+                status_code=503,
+                detail=f"Model {self.name} is busy, try again later",
+                headers={"Retry-After": str(retry_after)},
+            )
+
+        self.pending += 1
+        try:
+            if self.batcher:
+                return await self.batcher.submit(np_input)
+            return await self._predict(np_input)
+        finally:
+            self.pending -= 1
+
+    async def _predict(self, np_input):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        async with self._semaphore:
+            loop = asyncio.get_event_loop()
+            if self.executor == "process":
+                return await loop.run_in_executor(
+                    get_executor("process"), process_predict, self.name, self.source, np_input)
+            return await loop.run_in_executor(
+                get_executor("thread"), self.predict_sync, np_input)
+
+    def predict_sync(self, np_input):
+        return self.get_model().predict(np_input)
+
+    def get_model(self):
+        if self.model is not None:
+            return self.model
+        return model_cache.get((self.name, self.run_id), self.load)
+
+    def load(self):
+        model = mlflow.pyfunc.load_model(self.source)
+        return model, model_size(self.source)
+
+    def close(self):
+        """
+        Release the resources of a replaced handler
+        """
+        if self.batcher:
+            self.batcher.close()
+        if self.cache:
+            self.cache.clear()
+        model_cache.discard((self.name, self.run_id))
 
     def get_version_link(self, name, model_version):
         if withlinks:
@@ -251,14 +1426,6 @@ class PyFuncHandler:
             return self.get_nested(**el["tensor-spec"])
         return None
 
-    def numpy_input(self, data, input_cfg):
-        types = {el["name"]: el["tensor-spec"]["dtype"]
-                 for el in input_cfg.to_dict()}
-        return {
-            key: np.array(val).astype(types[key])
-            for key, val in data.items()
-        }
-
     def get_error_message(self, loc, ex):
         return HTTPException(status_code=442, detail=[
             {
@@ -283,45 +1450,361 @@ class PyFuncHandler:
             '</li></ul>'
 
 
-def update_models():
-    global model_dict
+models_lock = threading.Lock()
+loader = ThreadPoolExecutor(load_workers, thread_name_prefix="loader")
+loading = set()
 
-    for m in client.list_registered_models():
+# registry information of the loaded versions, shared with the other workers
+published = {}
+models_file = os.path.join(state_dir, "models.json")
+models_file_mtime = None
+coordinator_file = None
 
-        # get model information
-        name = urllib.parse.quote_plus(m.name)
-        description = m.description
+# refreshes requested at the followers, picked up by the coordinator
+refresh_dir = os.path.join(state_dir, "refresh")
 
-        # get the best version
-        model_version = get_version(m)
 
-        # if the currently loaded model is already ok
-        if name in model_dict and model_version.run_id == model_dict[name].run_id:
+def is_coordinator():
+    """
+    Check if this worker polls the registry, in multi worker mode the worker
+    holding the lock file is the coordinator. The lock is released when the
+    process ends, so a follower takes over in the next sync.
+    """
+    global coordinator_file
+
+    if not multi_worker or coordinator_file is not None:
+        return True
+
+    os.makedirs(state_dir, exist_ok=True)
+    f = open(os.path.join(state_dir, "coordinator.lock"), "w")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+
+    coordinator_file = f
+    logger.info(f"Worker {os.getpid()} is the model coordinator")
+    if published:
+        publish_models()
+    return True
+
+
+def publish_models():
+    """
+    Write the loaded versions for the other workers
+    """
+    with models_lock:
+        content = json.dumps(published)
+    os.makedirs(state_dir, exist_ok=True)
+    tmp_file = f"{models_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        f.write(content)
+    os.replace(tmp_file, models_file)
+
+
+def forward_refresh(name, force):
+    """
+    Ask the coordinator to refresh a model
+    """
+    os.makedirs(refresh_dir, exist_ok=True)
+    path = os.path.join(refresh_dir, name + ".json")
+    with open(f"{path}.{os.getpid()}.tmp", "w") as f:
+        json.dump({"force": force}, f)
+    os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+
+def forwarded_refreshes():
+    """
+    Refresh the models requested at the followers, runs in the coordinator
+    """
+    try:
+        files = [f for f in os.listdir(refresh_dir) if f.endswith(".json")]
+    except OSError:
+        return
+
+    for file_name in files:
+        path = os.path.join(refresh_dir, file_name)
+        try:
+            with open(path, "r") as f:
+                request = json.load(f)
+            os.remove(path)
+        except (OSError, ValueError):
             continue
 
+        try:
+            m = client.get_registered_model(urllib.parse.unquote_plus(file_name[:-len(".json")]))
+            el = check_model(m, request.get("force", False))
+        except Exception:
+            logger.exception(f"Forwarded refresh of {file_name} failed")
+            continue
+        if el is not None:
+            logger.info(f"Refresh model {el[0]} for a follower")
+            loader.submit(load_model, *el)
+
+
+def sync_models():
+    """
+    Follow the versions published by the coordinator, the followers never
+    query the registry themselves. The coordinator handles the refreshes
+    forwarded by the followers instead
+    """
+    global models_file_mtime, registry_listed
+
+    if is_coordinator():
+        forwarded_refreshes()
+        return
+
+    try:
+        mtime = os.path.getmtime(models_file)
+        if mtime == models_file_mtime:
+            return
+        with open(models_file, "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return
+
+    for name, el in state.items():
+        m = types.SimpleNamespace(
+            name=el["name"], description=el["description"], tags=el["tags"],
+            last_updated_timestamp=el["last_updated_timestamp"])
+        model_version = types.SimpleNamespace(
+            version=el["version"], run_id=el["run_id"], source=el["source"],
+            current_stage=el["current_stage"], generation=el.get("generation"))
+
+        with models_lock:
+            # a forced reload of the same run has a new generation
+            if name in model_dict and model_dict[name].run_id == model_version.run_id \
+                    and published.get(name, {}).get("generation") == model_version.generation:
+                continue
+            if name in loading:
+                continue
+            loading.add(name)
+
+        model_states[name] = {"state": "pending", "version": model_version.version}
+        logger.info(f"Follow model {name} version {model_version.version}")
+        loader.submit(load_model, name, m, model_version)
+
+    models_file_mtime = mtime
+    registry_listed = True
+
+
+def install_handler(name, handler):
+    """
+    Activate a loaded handler, its routes replace the routes of the old version
+    in place so the model is served without a gap
+    """
+    with models_lock:
+        old = model_dict.get(name)
+        routes = app.router.routes
+        old_routes = {r.path: r for r in old.routes} if old is not None else {}
+        for route in handler.routes:
+            old_route = old_routes.pop(route.path, None)
+            if old_route is not None and old_route in routes:
+                routes[routes.index(old_route)] = route
+            else:
+                routes.append(route)
+        for route in old_routes.values():
+            if route in routes:
+                routes.remove(route)
+        model_dict[name] = handler
+        update_openapi(old.openapi if old is not None else None, handler.openapi)
+
+    if old is not None:
+        old.close()
+
+
+def load_model(name, m, model_version):
+    """
+    Load, warm up and install a model version, runs in the loader pool
+    """
+    model_states[name] = {"state": "loading", "version": model_version.version}
+    try:
+        start = time.monotonic()
+        handler = PyFuncHandler(
+            name, model_version, m.description, get_settings(m))
+        install_handler(name, handler)
+        duration = time.monotonic() - start
+        model_load_time.labels(name).observe(duration)
+        model_states[name] = {"state": "ready",
+                              "version": model_version.version,
+                              "load_seconds": round(duration, 3)}
+        registry_timestamps[name] = m.last_updated_timestamp
+        # counts the loads of a model, the followers take the generation of the coordinator
+        generation = getattr(model_version, "generation", None) or \
+            published.get(name, {}).get("generation", 0) + 1
+        published[name] = {"name": m.name,
+                           "description": m.description,
+                           "tags": dict(getattr(m, "tags", None) or {}),
+                           "last_updated_timestamp": m.last_updated_timestamp,
+                           "version": model_version.version,
+                           "run_id": model_version.run_id,
+                           "source": model_version.source,
+                           "current_stage": model_version.current_stage,
+                           "generation": generation}
+        if multi_worker and coordinator_file is not None:
+            publish_models()
+        logger.info(
+            f"Loaded model {name} version {model_version.version} in {duration:.1f}s")
+    except Exception as ex:
+        model_states[name] = {"state": "failed",
+                              "version": model_version.version,
+                              "error": str(ex)}
+        logger.exception(
+            f"Loading model {name} version {model_version.version} failed")
+    finally:
+        with models_lock:
+            loading.discard(name)
+
+
+def list_models():
+    """
+    Iterate over all registered models page by page
+    """
+    page_token = None
+    while True:
+        page = client.list_registered_models(
+            max_results=registry_page_size, page_token=page_token)
+        for m in page:
+            yield m
+        page_token = page.token
+        if not page_token:
+            break
+
+
+def check_model(m, force=False):
+    """
+    Return the model and its selected version if it needs to be loaded,
+    the returned model is marked as loading
+    """
+    # get model information
+    name = urllib.parse.quote_plus(m.name)
+
+    with models_lock:
+        # nothing changed in the registry since the last check
+        if not force and name in model_dict and \
+                registry_timestamps.get(name) == m.last_updated_timestamp:
+            return None
+
+    # get the best version
+    model_version = get_version(m)
+
+    with models_lock:
+        # if the currently loaded model is already ok
+        if not force and name in model_dict and model_version.run_id == model_dict[name].run_id:
+            registry_timestamps[name] = m.last_updated_timestamp
+            return None
+
+        # the model is loaded right now, check it again in the next run
+        if name in loading:
+            return None
+        loading.add(name)
+
+    model_states[name] = {"state": "pending", "version": model_version.version}
+    return (name, m, model_version)
+
+
+def changed_models():
+    """
+    List the registered models whose selected version is not loaded yet,
+    unchanged models are skipped by their last update timestamp
+    """
+    global registry_listed
+
+    changed = []
+    for m in list_models():
+        el = check_model(m)
+        if el is not None:
+            changed.append(el)
+
+    registry_listed = True
+    return changed
+
+
+def update_models():
+    """
+    Check the registry and load changed models in the background,
+    the currently loaded versions keep serving until the new ones are ready
+    """
+    if not is_coordinator():
+        return
+
+    for name, m, model_version in changed_models():
         logger.info(f"Update model {name}")
+        loader.submit(load_model, name, m, model_version)
+
+    save_traffic()
+
+
+def load_priority(name, m):
+    """
+    Sort key of the startup, first the priority list then the most recent traffic
+    """
+    for idx, el in enumerate(priority):
+        if el in (m.name, name):
+            return (0, idx)
+    return (1, -traffic.get(name, 0))
+
+
+def startup_models(wait=False, coordinate=True):
+    """
+    Load all models on cold start with MLSERVE_STARTUP_WORKERS in parallel
+    """
+    if coordinate and not is_coordinator():
+        return
+
+    load_traffic()
+    changed = sorted(changed_models(), key=lambda el: load_priority(el[0], el[1]))
+    logger.info(f"Load {len(changed)} models")
+
+    pool = ThreadPoolExecutor(startup_workers, thread_name_prefix="startup")
+    for name, m, model_version in changed:
+        pool.submit(load_model, name, m, model_version)
+    pool.shutdown(wait=wait)
+
+
+def start_scheduler():
+    global scheduler
+
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(func=update_models, trigger="interval", seconds=300)
+    scheduler.add_job(func=reload_tokens, trigger="interval", seconds=token_reload)
+    scheduler.add_job(func=startup_models,
+                      trigger="date",
+                      run_date=datetime.datetime.now()
+                      + datetime.timedelta(seconds=startup_delay))
+    if multi_worker:
+        scheduler.add_job(func=sync_models, trigger="interval", seconds=sync_interval)
+    scheduler.start()
+
 
-        # delete old route
-        for idx2 in [idx for idx, r in enumerate(app.routes) if r.path == basepath+"/"+name]:
-            del app.routes[idx2]
+def reset_after_fork():
+    """
+    Threads and locks do not survive a fork, recreate them in the child
+    """
+    global loader, models_lock, executors_lock, coordinator_file
 
-        # create new handler
-        model_dict[name] = PyFuncHandler(name, model_version, description)
+    loader = ThreadPoolExecutor(load_workers, thread_name_prefix="loader")
+    models_lock = threading.Lock()
+    executors_lock = threading.Lock()
+    executors.clear()
+    coordinator_file = None
 
-    app.openapi_schema = None
 
+if preload:
+    # load in the master process, the scheduler starts in each forked worker
+    os.register_at_fork(after_in_child=reset_after_fork)
+    startup_models(wait=True, coordinate=False)
 
-scheduler = BackgroundScheduler()
-scheduler.add_job(func=update_models, trigger="interval", seconds=300)
-scheduler.add_job(func=update_models,
-                  trigger="date",
-                  run_date=datetime.datetime.now()
-                  + datetime.timedelta(seconds=10))
-scheduler.start()
+    @app.on_event("startup")
+    def start_worker():
+        start_scheduler()
+else:
+    start_scheduler()
 
 if __name__ == "__main__":
     import uvicorn
     logger.setLevel(logging.DEBUG)
-    update_models()
+    startup_models()
     uvicorn.run(app, port=4041)
 
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Binary encoding of named tensors for the MLflow model server
+
+Layout of a message:
+
+    4 bytes   magic b"AFHT"
+    4 bytes   length of the header, unsigned little-endian
+    n bytes   JSON header {"tensors": [{"name", "dtype", "shape", "offset", "nbytes"}]}
+    ...       raw C-ordered little-endian buffers, each aligned to 64 bytes
+
+The offsets are relative to the start of the data section. Decoding maps the
+buffers with np.frombuffer, the arrays share the memory of the message and are
+read-only. A stream is a plain concatenation of messages.
+
+A failed stream ends with an error message, its header holds {"tensors": [],
+"error": "..."} and decode raises StreamError with the error.
+"""
+
+import json
+import struct
+import numpy as np
+
+content_type = "application/x-afhub-tensors"
+
+MAGIC = b"AFHT"
+ALIGNMENT = 64
+
+
+class StreamError(Exception):
+    """
+    The server reported an error in a tensor stream
+    """
+
+
+def is_tensor_type(value):
+    """
+    Check if a Content-Type or Accept header asks for the binary format
+    """
+    return value is not None and content_type in value
+
+
+def _padding(size):
+    return (-size) % ALIGNMENT
+
+
+def encode(tensors):
+    """
+    Encode a dict of arrays into a single bytes message
+    """
+    entries = []
+    buffers = []
+    offset = 0
+    for name, value in tensors.items():
+        arr = np.asarray(value)
+        if arr.dtype.hasobject:
+            raise ValueError(f"Tensor {name} with dtype {arr.dtype} can not be encoded")
+        arr = arr.astype(arr.dtype.newbyteorder("<"), order="C", copy=False)
+
+        entries.append({"name": name,
+                        "dtype": arr.dtype.str,
+                        "shape": list(arr.shape),
+                        "offset": offset,
+                        "nbytes": arr.nbytes})
+        buffers.append(memoryview(arr.reshape(-1).view(np.uint8)))
+        buffers.append(b"\0" * _padding(arr.nbytes))
+        offset += arr.nbytes + _padding(arr.nbytes)
+
+    header = json.dumps({"tensors": entries}).encode("utf-8")
+    prefix = MAGIC + struct.pack("<I", len(header)) + header
+    prefix += b"\0" * _padding(len(prefix))
+
+    return b"".join([prefix] + buffers)
+
+
+def encode_error(detail):
+    """
+    Encode an error message, decode raises StreamError with detail
+    """
+    header = json.dumps({"tensors": [], "error": str(detail)}).encode("utf-8")
+    prefix = MAGIC + struct.pack("<I", len(header)) + header
+    return prefix + b"\0" * _padding(len(prefix))
+
+
+def message_size(data):
+    """
+    Total size of the message at the start of data, None while the header is incomplete
+    """
+    if len(data) < 8:
+        return None
+    if data[:4] != MAGIC:
+        raise ValueError("Invalid tensor message")
+
+    (length,) = struct.unpack_from("<I", data, 4)
+    if len(data) < 8 + length:
+        return None
+    header = json.loads(bytes(data[8:8 + length]).decode("utf-8"))
+    start = 8 + length + _padding(8 + length)
+    return start + max([el["offset"] + el["nbytes"] + _padding(el["nbytes"])
+                        for el in header["tensors"]] + [0])
+
+
+def decode(data):
+    """
+    Decode a message into a dict of read-only arrays without copying the buffers
+    """
+    if data[:4] != MAGIC:
+        raise ValueError("Invalid tensor message")
+
+    (length,) = struct.unpack_from("<I", data, 4)
+    header = json.loads(bytes(data[8:8 + length]).decode("utf-8"))
+    if "error" in header:
+        raise StreamError(header["error"])
+    start = 8 + length + _padding(8 + length)
+
+    output = {}
+    for el in header["tensors"]:
+        dtype = np.dtype(el["dtype"])
+        count = int(np.prod(el["shape"], dtype=np.int64))
+        if el["nbytes"] != count * dtype.itemsize or start + el["offset"] + el["nbytes"] > len(data):
+            raise ValueError(f"Tensor {el['name']} does not match its buffer")
+        output[el["name"]] = np.frombuffer(
+            data, dtype=dtype, count=count, offset=start + el["offset"]).reshape(el["shape"])
+    return output
+
+
+class InputDecoder:
+    """
+    Convert request inputs to the arrays of a model input schema
+
+    The dtype, shape and default of each input are computed once from the
+    schema, a request only converts each input in a single pass and checks the
+    shape of the resulting array instead of validating every element.
+    """
+
+    def __init__(self, schema, defaults=None):
+        self.dtypes = {}
+        self.shapes = {}
+        for el in schema:
+            spec = el.get("tensor-spec")
+            self.dtypes[el["name"]] = np.dtype(spec["dtype"]) if spec else None
+            self.shapes[el["name"]] = tuple(spec["shape"]) if spec else None
+
+        # inputs can be stacked along the first axis if it is the batch axis,
+        # inputs without a tensor-spec are columns with a row per element
+        self.batched = all(shape is None or (len(shape) > 0 and shape[0] == -1)
+                           for shape in self.shapes.values())
+
+        self.defaults = {}
+        for name, value in (defaults or {}).items():
+            if name in self.dtypes and value is not None:
+                try:
+                    self.defaults[name] = self._convert(name, value)
+                except (ValueError, TypeError):
+                    pass
+
+    def _convert(self, name, value):
+        arr = np.asarray(value, dtype=self.dtypes[name])
+        self._check(name, arr)
+        return arr
+
+    def _check(self, name, arr):
+        shape = self.shapes[name]
+        if shape is None:
+            return
+        if arr.ndim != len(shape) or any(s != -1 and s != a for s, a in zip(shape, arr.shape)):
+            raise ValueError(f"Input {name} has shape {list(arr.shape)}, expected {list(shape)}")
+
+    def decode(self, data):
+        """
+        Convert a dict of (nested) lists, inputs missing in data take their default
+        """
+        output = dict(self.defaults)
+        for name, value in data.items():
+            if name not in self.dtypes:
+                continue
+            output[name] = self._convert(name, value)
+        missing = set(self.dtypes) - set(output)
+        if missing:
+            raise ValueError(f"Missing inputs {sorted(missing)}")
+        return output
+
+    def cast(self, arrays):
+        """
+        Check and cast decoded binary tensors, arrays with the right dtype are not copied
+        """
+        output = dict(self.defaults)
+        for name, arr in arrays.items():
+            if name not in self.dtypes:
+                continue
+            if self.dtypes[name] is not None:
+                arr = arr.astype(self.dtypes[name], copy=False)
+            self._check(name, arr)
+            output[name] = arr
+        missing = set(self.dtypes) - set(output)
+        if missing:
+            raise ValueError(f"Missing inputs {sorted(missing)}")
+        return output
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compare the input decoding of the model server for large tensors
+
+before: JSON body parsed into the pydantic input model, then np.array(...).astype(...)
+after:  JSON body decoded by the precompiled InputDecoder
+binary: the application/x-afhub-tensors body decoded by the InputDecoder
+
+Usage: python benchmarks/input_decoding.py [rows] [columns]
+"""
+
+import sys
+import json
+import time
+
+import numpy as np
+try:
+    # the server ran on pydantic 1
+    from pydantic.v1 import BaseModel
+except ImportError:
+    from pydantic import BaseModel
+
+from afhub import tensors
+
+
+def timeit(func, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def main(rows=256, columns=1024):
+    schema = [{"name": "x", "type": "tensor",
+               "tensor-spec": {"dtype": "float32", "shape": [-1, columns]}}]
+    data = np.random.rand(rows, columns).astype("float32")
+    body = json.dumps({"x": data.tolist()}).encode("utf-8")
+    binary = tensors.encode({"x": data})
+
+    # the server built the pydantic model from the input example as defaults,
+    # the field types are inferred from them, i.e. a plain list without element checks
+    InputModel = type("bench-input", (BaseModel, ), {"x": data[:1].tolist()})
+    decoder = tensors.InputDecoder(schema)
+
+    def before():
+        parsed = InputModel(**json.loads(body))
+        types = {el["name"]: el["tensor-spec"]["dtype"] for el in schema}
+        return {key: np.array(val).astype(types[key]) for key, val in parsed.__dict__.items()}
+
+    def after():
+        return decoder.decode(json.loads(body))
+
+    def after_binary():
+        return decoder.cast(tensors.decode(binary))
+
+    print(f"tensor {rows}x{columns} float32, JSON body {len(body) / 1e6:.1f} MB, "
+          f"binary body {len(binary) / 1e6:.1f} MB")
+    for name, func in [("before", before), ("after", after), ("binary", after_binary)]:
+        print(f"{name:>8}: {timeit(func) * 1000:9.2f} ms")
+
+
+if __name__ == "__main__":
+    main(*[int(el) for el in sys.argv[1:]])